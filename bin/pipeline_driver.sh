@@ -27,7 +27,7 @@ banner () {
 }
 
 # ────────────────────────────────────────────────────────────────────────────
-# Function: download  (update 45 samples)
+# Function: download  (update up to MAX_SAMPLES samples)
 # ────────────────────────────────────────────────────────────────────────────
 download () {
   banner "Update samples"
@@ -61,7 +61,10 @@ stitch () {
         --samples-root  "$SAMPLES_ROOT" \
         --stitched-root "$STITCHED_TOPIC" \
         --out-root      "$STITCHED_TOPIC" \
-        --workers       "$WORKERS"
+        --workers       "$WORKERS" \
+        --storage       "$STORAGE" \
+        --num-samples   "$MAX_SAMPLES" \
+        --incremental
   done
 }
 
@@ -0,0 +1,102 @@
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import tempfile
+import time
+
+import pandas as pd
+
+SRC = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(SRC)
+from lib import storage
+from lib import trends_async
+from trends_standin import StandIn, serve, discovery_url
+
+FETCHERS = ("process", "async")
+
+
+def collect(args, fetcher, url, workdir):
+    """Run get_gt_data.py against the stand-in in workdir; returns the elapsed seconds and windows stored."""
+    output_dir = os.path.join(workdir, "sample0")
+    command = [sys.executable, os.path.join(SRC, "get_gt_data.py"),
+               "--country_code", "countries.csv",
+               "--data_output_existing", output_dir,
+               "--no_daily_update",
+               "--start_month", args.start_month,
+               "--end_month", args.end_month,
+               "--storage", args.storage,
+               "--fetcher", fetcher]
+    if fetcher == "async":
+        command += ["--rate", str(args.rate), "--burst", str(args.burst), "--concurrency", str(args.concurrency),
+                    "--max_concurrency", str(args.max_concurrency), "--backoff", str(args.backoff)]
+
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    with open(os.path.join(workdir, "get_gt_data.out"), "w") as out:
+        subprocess.run(command, cwd=workdir, env=dict(os.environ, DISCOVERY_URL=url), stdout=out, stderr=subprocess.STDOUT, check=True)
+    elapsed = time.perf_counter() - start
+
+    windows = sum(len(storage.window_files(os.path.join(output_dir, c), coarse)) for c in os.listdir(output_dir)
+                  if os.path.isdir(os.path.join(output_dir, c)) for coarse in (False, True))
+    return elapsed, windows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test get_gt_data.py against a local Trends stand-in: requests/sec, retry overhead and collection time")
+    parser.add_argument("--fetcher", action="append", choices=FETCHERS, help="fetchers to run (default = all); "
+                        "the process fetcher sleeps (i + 1) * 61 s on the i-th 429 of a window, so keep it to runs without 429s")
+    parser.add_argument("--repeats", type=int, default=3, help="collections per fetcher")
+    parser.add_argument("--countries", type=int, default=10, help="countries downloaded, from country_codes.csv")
+    parser.add_argument("--start_month", default="2023-01")
+    parser.add_argument("--end_month", default="2024-12")
+    parser.add_argument("--storage", choices=storage.FORMATS, default=storage.CSV)
+
+    server = parser.add_argument_group("stand-in")
+    server.add_argument("--latency", type=float, default=0.3, help="seconds every request takes at least")
+    server.add_argument("--jitter", type=float, default=0.2, help="up to this many seconds more, at random")
+    server.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429 at random")
+    server.add_argument("--rate-limit", type=float, default=None, help="requests per second within quota; beyond it 429s")
+    server.add_argument("--quota-burst", type=int, default=1, help="requests within quota at once after an idle period")
+
+    fetch = parser.add_argument_group("async fetcher (as in get_gt_data.py)")
+    fetch.add_argument("--rate", type=float, default=trends_async.RATE)
+    fetch.add_argument("--burst", type=int, default=trends_async.BURST)
+    fetch.add_argument("--concurrency", type=int, default=trends_async.CONCURRENCY)
+    fetch.add_argument("--max_concurrency", type=int, default=trends_async.MAX_CONCURRENCY)
+    fetch.add_argument("--backoff", type=float, default=trends_async.BACKOFF)
+
+    args = parser.parse_args()
+
+    countries = pd.read_csv(os.path.join(SRC, "..", "country_codes.csv"))["country_code"].head(args.countries)
+    standin = StandIn(args.latency, args.jitter, args.error_rate, args.rate_limit, args.quota_burst)
+    httpd = serve(standin)
+
+    for fetcher in args.fetcher or FETCHERS:
+        timings, rates, overheads, rate_limited = [], [], [], 0
+        for _ in range(args.repeats):
+            with tempfile.TemporaryDirectory() as workdir:
+                with open(os.path.join(workdir, "api_key.txt"), "w") as f:
+                    f.write("stand-in")
+                countries.to_frame().to_csv(os.path.join(workdir, "countries.csv"), index=False)
+
+                before = standin.snapshot()
+                elapsed, windows = collect(args, fetcher, discovery_url(httpd), workdir)
+                after = standin.snapshot()
+
+            requests, ok = after["requests"] - before["requests"], after["ok"] - before["ok"]
+            timings.append(elapsed)
+            rates.append(requests / elapsed)
+            overheads.append((requests - ok) / ok if ok else float("inf"))
+            rate_limited += after["rate_limited"] - before["rate_limited"]
+
+        print(f"{fetcher:<8} collection median {statistics.median(timings):.2f}s  min {min(timings):.2f}s  "
+              f"{statistics.median(rates):.1f} requests/s  retry overhead {statistics.median(overheads):.1%}  "
+              f"{rate_limited} 429s  {windows} windows")
+
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+SRC = os.path.dirname(os.path.realpath(__file__))
+
+# what a detection process imports before it can start, timed in a fresh interpreter each time
+STAGES = {
+    "lib.detection": "import lib.detection",
+    "chebyshev": "from lib.detection import ChebyshevInequality; ChebyshevInequality()",
+    "chebyshev (shapiro)": "from lib.detection import shapiro_normality; shapiro_normality([1.0, 2.0, 4.0])",
+    "chebyshev (compiled)": "from lib import detection_kernel",
+    "median": "from lib.detection import MedianMethod; MedianMethod(3, 1.5, 5, 0.05)",
+    "iforest": "from lib.detection import IsolationForest; IsolationForest(60)",
+    "lof": "from lib.detection import LocalOutlierFactor; LocalOutlierFactor(60)",
+    "run_potentialblockalert": "import run_potentialblockalert",
+}
+
+TIMER = "import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)"
+
+
+def time_stage(statement, repeats):
+    timings = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-c", TIMER.format(statement)], cwd=SRC,
+                                capture_output=True, text=True, check=True)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time of the detection modules, each in a fresh interpreter")
+    parser.add_argument("--repeats", type=int, default=5, help="interpreters started per stage")
+    parser.add_argument("--stage", action="append", choices=list(STAGES), help="stages to time (default = all)")
+
+    args = parser.parse_args()
+
+    for stage in args.stage or STAGES:
+        timings = time_stage(STAGES[stage], args.repeats)
+        print(f"{stage:<25} median {statistics.median(timings):.3f}s  min {min(timings):.3f}s  max {max(timings):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,11 @@ SCRIPT_PATH="src/run_potentialblockalert.py"
 # Top-level where your term subdirectories live
 TERMS_ROOT=$BASE_ROOT
 
+# terms whose detection failed for some country; the rest still run
+FAILED_TERMS=()
+
+WORKERS=$(command -v nproc >/dev/null && nproc || python3 - <<<'import os; print(os.cpu_count())')
+
 for term_dir in "$TERMS_ROOT"/*; do
   # Strip trailing slash and leading path
   term=$(basename "${term_dir%/}")
@@ -45,26 +50,26 @@ fi
 
 mkdir -p "$OUTPUT_BASE"
 
-for param_file in "$PARAMS_DIR"/*; do
-  country_code=$(basename "$param_file")
-  country_dir=$OUTPUT_BASE"/$country_code"
-  mkdir -p "$country_dir"
-  time_series_file="${TIME_SERIES_DIR}/${country_code}_stitched.csv"
-
-  if [[ ! -f "$time_series_file" ]]; then
-    echo "  ⚠️  No time series for ${country_code}, skipping."
-    continue
-  fi
-
-python "$SCRIPT_PATH" \
-  --path "$time_series_file" \
+# one interpreter per term; countries are spread over a process pool
+if ! python "$SCRIPT_PATH" \
+  --stitched-root "$TIME_SERIES_DIR" \
+  --param-root "$PARAMS_DIR" \
   --events "$DUMMY_EVENTS" \
   --algorithm "$ALGORITHM" \
-  --parameters "$param_file"\
-  --output "$country_dir"
+  --output "$OUTPUT_BASE" \
+  --workers "$WORKERS" \
+  --storage "$STORAGE" \
+  --resume; then
+  echo "  › Detection failed for some countries of $term" >&2
+  FAILED_TERMS+=("$term")
+fi
 
 echo "=== Done term: $term ==="$'\n'
 done
 
 echo "All terms processed!"
-done
\ No newline at end of file
+
+if [[ ${#FAILED_TERMS[@]} -gt 0 ]]; then
+  echo "❌ Detection failed in: ${FAILED_TERMS[*]}" >&2
+  exit 1
+fi
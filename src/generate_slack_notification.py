@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import sys
 import csv
 import logging
 from pathlib import Path
@@ -11,6 +12,9 @@ import pickle
 import seaborn as sns
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from lib import storage
+
 import importlib.util, importlib.machinery
 
 loader = importlib.machinery.SourceFileLoader("bin/config", "./bin/config")
@@ -137,7 +141,7 @@ def _write_text(msg: str, out_dir, country_code, topic, start):
 
 
 def generate_plot(country_code: str, start: datetime, end: datetime, topic: str, out):
-    df = pl.read_csv(os.path.join("final_output", topic, country_code, "annotated.csv"), try_parse_dates=True)
+    df = storage.read_frame(storage.find_series(os.path.join("final_output", topic, country_code, "annotated")))
     with open(os.path.join("ChebyshevPreferredFinal", topic, country_code), "rb") as file:
         parameters = pickle.load(file)
         window_size = round(parameters[0])
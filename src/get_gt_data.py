@@ -2,17 +2,34 @@
 import argparse
 import datetime
 import logging
+import multiprocessing
 import os
 import pandas as pd
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 
 from lib.google_trends_utils import *
+from lib.storage import FORMATS
+from lib import trends_async
+from lib.request_plan import plan_requests
+from lib.download_journal import DownloadJournal
 
 from googleapiclient.discovery import build
 
 logger = logging.getLogger()
 
+def setup_logger(log_path):
+    formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    file_handler = logging.FileHandler(log_path,mode="a")
+    stream_handler = logging.StreamHandler()
+    
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+    
+    logger.addHandler(file_handler)
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging.INFO)
+
 def main():
     parser = argparse.ArgumentParser(description='Downloader for Google Trends Data')
 
@@ -49,6 +66,46 @@ def main():
                         default=VPN_GT_TOPIC_CODE,
                         help='topic to download')
     
+    parser.add_argument('--storage',
+                        default="csv",
+                        choices=FORMATS,
+                        help='csv writes one file per window, parquet one windows.parquet per country directory')
+
+    parser.add_argument('--redownload',
+                        action='store_true',
+                        help='download windows again that are already stored in the output directory')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='download only the windows the journal of the output directory does not have done and unchanged')
+    parser.add_argument('--plan_only',
+                        action='store_true',
+                        help='report the planned requests and exit without sending any')
+
+    parser.add_argument('--fetcher',
+                        default="process",
+                        choices=["process", "async"],
+                        help='process downloads each country in one of 3 worker processes, async all windows on one event loop with a shared rate limit')
+    parser.add_argument('--rate',
+                        default=trends_async.RATE,
+                        help='async fetcher: average requests per second',
+                        type=float)
+    parser.add_argument('--burst',
+                        default=trends_async.BURST,
+                        help='async fetcher: requests that may be sent at once after an idle period',
+                        type=int)
+    parser.add_argument('--concurrency',
+                        default=trends_async.CONCURRENCY,
+                        help='async fetcher: requests in flight to start with',
+                        type=int)
+    parser.add_argument('--max_concurrency',
+                        default=trends_async.MAX_CONCURRENCY,
+                        help='async fetcher: most requests in flight',
+                        type=int)
+    parser.add_argument('--backoff',
+                        default=trends_async.BACKOFF,
+                        help='async fetcher: seconds all requests pause after the first 429 of a request, doubling on each further one',
+                        type=float)
+
     parser.add_argument('--start_month',
                         default= "2011-01",
                         help='start month formatted like 2011-01')
@@ -77,98 +134,115 @@ def main():
         timestamp_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") 
 
     # set up logger
-    formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-    file_handler = logging.FileHandler(os.path.join(os.path.dirname(output_dir), "log.log"),mode="a")
-    stream_handler = logging.StreamHandler()
-    
-    file_handler.setFormatter(formatter)
-    stream_handler.setFormatter(formatter)
-    
-    global logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
-    logger.setLevel(logging.INFO)
+    log_path = os.path.join(os.path.dirname(output_dir), "log.log")
+    setup_logger(log_path)
 
     # add some logger mode announcement
     collection_type = "initial collection" if args.data_output_existing is None else "recollection"
 
     logger.info(f"Running for {collection_type}, writing to {output_dir}")
 
-    # grab dev key
-    with open("api_key.txt") as f:
-        API_KEY = f.read()
+    # (country_dir, start, window start, end, country_code) of each multi_timeline_requests call
+    jobs = []
 
-    # Start Service
-    service = build('trends', 'v1beta', developerKey=API_KEY, discoveryServiceUrl=DISCOVERY_URL)
-    
     # daily update on the dataset
     if args.daily_update == True:
         unique_country_codes = df['country_code'].unique()
-        with ProcessPoolExecutor(max_workers=3) as executor:
-            # Go through every country code
-            for country_code in tqdm(unique_country_codes, desc='Country code progress'):
-                country_dir = os.path.join(output_dir, country_code) 
-                os.makedirs(country_dir, exist_ok=True)
-               
-                country_processed = False
-               
-                # build window dir
-                if not country_processed:
-                    start_date_str = args.start_month
-                    end_date_str = args.end_month
-                    country_processed = True
-                else:
-                    # only download full time series once
-                    continue
-                window_s_str = (datetime.datetime.today() - relativedelta(days=1, months=args.sliding_window_overlap)).strftime("%Y-%m")
-                
-
-                tlvl_args = (service, logger, country_dir, start_date_str, window_s_str, end_date_str, country_code)
-                    
-                # now build window data
-                executor.submit(get_multi_timeline_windows, *tlvl_args, args.topic, args.sliding_window_size, args.sliding_window_overlap)
+        # Go through every country code
+        for country_code in unique_country_codes:
+            country_dir = os.path.join(output_dir, country_code) 
+            os.makedirs(country_dir, exist_ok=True)
+           
+            country_processed = False
+           
+            # build window dir
+            if not country_processed:
+                start_date_str = args.start_month
+                end_date_str = args.end_month
+                country_processed = True
+            else:
+                # only download full time series once
+                continue
+            window_s_str = (datetime.datetime.today() - relativedelta(days=1, months=args.sliding_window_overlap)).strftime("%Y-%m")
+
+            jobs.append((country_dir, start_date_str, window_s_str, end_date_str, country_code))
 
     # Mass downloading
     elif args.target_windows is None:
         unique_country_codes = df['country_code'].unique()
 
-        with ProcessPoolExecutor(max_workers=3) as executor:
-            # Go through every country code
-            for country_code in tqdm(unique_country_codes, desc='Country code progress'):
-                country_dir = os.path.join(output_dir, country_code) 
-                os.makedirs(country_dir, exist_ok=True)
-               
-                country_processed = False
-               
-                # build window dir
-                if not country_processed:
-                    start_date_str = args.start_month
-                    end_date_str = args.end_month
-                    country_processed = True
-                else:
-                    # only download full time series once
-                    continue
-               
-                tlvl_args = (service, logger, country_dir, start_date_str, start_date_str, end_date_str, country_code)
-                
-                # now build window data
-                executor.submit(get_multi_timeline_windows, *tlvl_args, args.topic, args.sliding_window_size, args.sliding_window_overlap)
+        # Go through every country code
+        for country_code in unique_country_codes:
+            country_dir = os.path.join(output_dir, country_code) 
+            os.makedirs(country_dir, exist_ok=True)
+           
+            country_processed = False
+           
+            # build window dir
+            if not country_processed:
+                start_date_str = args.start_month
+                end_date_str = args.end_month
+                country_processed = True
+            else:
+                # only download full time series once
+                continue
+
+            jobs.append((country_dir, start_date_str, start_date_str, end_date_str, country_code))
     else:
-        with ProcessPoolExecutor(max_workers=3) as executor:
-        
-            for _, row in tqdm(df.iterrows(), total=len(df), desc='Target windows progress'):
-                country_code = row['country_code']
-                start_date_str = row['start_month']
-                end_date_str = row['end_month']
+        for _, row in df.iterrows():
+            country_code = row['country_code']
+            start_date_str = row['start_month']
+            end_date_str = row['end_month']
+
+            country_dir = os.path.join(output_dir, country_code)
+            if not os.path.exists(country_dir):
+                os.makedirs(country_dir)
+                logger.warning(f"Running for {collection_type}, writing to {output_dir}, but {country_dir} does not exist")
+
+            jobs.append((country_dir, start_date_str, start_date_str, end_date_str, country_code))
+
+    # plan every window of the run before sending anything
+    requests = [request for job in jobs
+                for request in multi_timeline_requests(*job, args.topic, args.sliding_window_size, args.sliding_window_overlap)]
+    journal = DownloadJournal(output_dir)
+    journal.record(requests)
+    completed = journal.completed(requests) if args.resume else None
+    plan = plan_requests(requests, redownload=args.redownload, completed=completed)
+    logger.info(f"Request plan: {plan.summary()}")
+    if args.plan_only:
+        journal.close()
+        return
 
-                country_dir = os.path.join(output_dir, country_code)
-                if not os.path.exists(country_dir):
-                    os.makedirs(country_dir)
-                    logger.warning(f"Running for {collection_type}, writing to {output_dir}, but {country_dir} does not exist")
+    # grab dev key
+    with open("api_key.txt") as f:
+        API_KEY = f.read()
 
-                tlvl_args = (service, logger, country_dir, start_date_str, start_date_str, end_date_str, country_code)
+    # Start Service
+    service = build('trends', 'v1beta', developerKey=API_KEY, discoveryServiceUrl=DISCOVERY_URL)
+
+    if args.fetcher == "async":
+        # every request of every country goes through one shared rate limit
+        stats = trends_async.download_windows(service, logger, plan.queries, args.storage,
+                                              rate=args.rate, burst=args.burst, concurrency=args.concurrency,
+                                              max_concurrency=args.max_concurrency, backoff=args.backoff,
+                                              journal=journal)
+        logger.info(f"Downloaded {stats['downloaded']} of {plan.cost} planned requests with {stats['requests']} requests "
+                    f"({stats['rate_limited']} rate limited, {stats['failed']} failed, {stats['empty']} empty)")
+    else:
+        # the queries of a country stay in one process, in order
+        country_queries = {}
+        for query in plan.queries:
+            country_queries.setdefault(query.requests[0].dest, []).append(query)
+
+        # polars is not fork safe once planning has used it, so workers start fresh and set up logging again
+        with ProcessPoolExecutor(max_workers=3, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=setup_logger, initargs=(log_path,)) as executor:
+            for queries in tqdm(country_queries.values(), desc='Country code progress'):
+                # now build window data
+                executor.submit(get_multi_timeline_queries, service, logger, queries, args.storage, journal)
 
-                executor.submit(get_multi_timeline_windows, *tlvl_args, args.topic, args.sliding_window_size, args.sliding_window_overlap)
+    logger.info("Journal: {done} windows done, {failed} failed, {pending} pending".format(**journal.counts()))
+    journal.close()
 
 if __name__ == "__main__":
     main()
@@ -1,3 +1,4 @@
+import math
 from abc import ABC, abstractmethod
 from enum import StrEnum
 from datetime import timedelta
@@ -5,14 +6,8 @@ from datetime import timedelta
 import polars as pl
 import numpy as np
 
-from scipy.stats import shapiro
-from scipy.stats.mstats import winsorize
-from more_itertools import consecutive_groups
-
-import isotree
-import sklearn.neighbors
-import statsforecast.models
-from scipy.optimize import minimize_scalar
+# scipy.stats, scipy.optimize, isotree and statsforecast take seconds to import between
+# them and each is only needed on some paths, so they are imported where they are used
 
 class DemandCategorization(StrEnum):
     ERRATIC = "erratic"
@@ -22,21 +17,85 @@ class DemandCategorization(StrEnum):
     NONE = "none"
 
 
+class NormalityTest(StrEnum):
+    SHAPIRO = "shapiro"
+    JARQUE_BERA = "jarque-bera"
+
+
+# smoothing constant and bias correction used by statsforecast.models.CrostonSBA
+CROSTON_ALPHA = 0.1
+CROSTON_SBA_FACTOR = 0.95
+
+DEMAND_CATEGORIES = list(DemandCategorization)
+DEMAND_CODES = {category: code for code, category in enumerate(DEMAND_CATEGORIES)}
+DEMAND_PATTERNS = np.array([str(category) for category in DEMAND_CATEGORIES])
+
+
+def shapiro_normality(values, alpha=0.05):
+    from scipy.stats import shapiro
+
+    try:
+        _, p = shapiro(values)
+        return p >= alpha
+    except ValueError: return False
+
+
+def jarque_bera_normality(values, alpha=0.05):
+    """
+    Approximate normality test from the sample skewness and kurtosis. The Jarque-Bera statistic
+    is chi-squared with two degrees of freedom, whose p-value has the closed form exp(-JB / 2).
+    Written with plain loops so lib.detection_kernel can compile the same function.
+    """
+    n = len(values)
+    if n < 3: return False
+
+    mean = 0.0
+    for value in values: mean += value
+    mean /= n
+
+    m2, m3, m4 = 0.0, 0.0, 0.0
+    for value in values:
+        deviation = value - mean
+        squared = deviation * deviation
+        m2 += squared
+        m3 += squared * deviation
+        m4 += squared * squared
+    m2, m3, m4 = m2 / n, m3 / n, m4 / n
+    # constant windows are normal, as with shapiro
+    if m2 == 0: return True
+
+    skewness = m3 / m2 ** 1.5
+    excess_kurtosis = m4 / (m2 * m2) - 3
+    jb = n / 6 * (skewness * skewness + excess_kurtosis * excess_kurtosis / 4)
+    return math.exp(-jb / 2) >= alpha
+
+
+NORMALITY_TESTS = {NormalityTest.SHAPIRO: shapiro_normality, NormalityTest.JARQUE_BERA: jarque_bera_normality}
+
+
 class Window():
     def __init__(self, min_observations=None):
         self._min_observations = min_observations
-        self._window = np.array([])
-        self._interarrivals = np.array([])
-        self._last_arrival = None
+        # incremented whenever the contents change; keys the cached normality verdict
+        self._version = 0
+        self._normality_key = None
+        self.clear()
 
     def clear(self):
+        self._version += 1
         self._window = np.array([])
         self._interarrivals = np.array([])
         self._last_arrival = None
+
+    def _values(self):
+        return self._window
+
+    def _gaps(self):
+        return self._interarrivals
     
     def _window_operation(self, operation, default):
         #if self._min_observations and self._window.size < self._min_observations: return default
-        return operation(self._window)
+        return operation(self._values())
     
     def sum(self):
         return self._window_operation(np.sum, np.nan)
@@ -51,22 +110,24 @@ class Window():
         return self._window_operation(np.median, np.nan)
     
     def diff(self):
-        return np.diff(self._window)
+        return np.diff(self._values())
     
-    def normality(self, alpha=0.05):
-        try:
-            _, p = shapiro(self._window)
-            return p >= alpha
-        except ValueError: return False
+    def normality(self, alpha=0.05, test=NormalityTest.SHAPIRO):
+        # the verdict only depends on the window contents, so it is reused until they change
+        key = (self._version, alpha, test)
+        if self._normality_key != key:
+            self._normality_key = key
+            self._normality = NORMALITY_TESTS[test](self._values(), alpha)
+        return self._normality
     
     def average_interdemand_interval(self, timestamp):
-        return np.mean(np.append(self._interarrivals, timestamp - self._last_arrival)) if self._last_arrival is not None else np.nan
+        return np.mean(np.append(self._gaps(), timestamp - self._last_arrival)) if self._last_arrival is not None else np.nan
 
     def cov(self):
-        return np.std(self._window) / np.mean(self._window) if len(self) > 0 else np.nan
+        return self.std() / self.mean() if len(self) > 0 else np.nan
     
     def classify_demand(self, timestamp):
-        cov_squared = self.cov() ** 2
+        cov_squared = np.square(self.cov())
         adi = self.average_interdemand_interval(timestamp)
 
         if adi <= 1.32 and cov_squared > 0.49: return DemandCategorization.ERRATIC
@@ -76,50 +137,181 @@ class Window():
         return DemandCategorization.NONE
 
     def sparsity(self):
-        return 1 - (np.count_nonzero(self._window) / len(self._window))
+        return 1 - (np.count_nonzero(self._values()) / len(self))
     
     def scale(self, factor):
-        self._window = np.multiply(self._window, factor)
+        self.replace(np.multiply(self._values(), factor))
+
+    def replace(self, values):
+        self._version += 1
+        self._window = np.asarray(values, dtype=float)
 
     def to_array(self):
         if self._last_arrival is None: return np.array([])
-        array = np.zeros(int(self._interarrivals.sum()))
-        indices = np.cumsum(self._interarrivals, dtype=int) - 1
-        array[indices] = self._window
+        gaps = self._gaps()
+        array = np.zeros(int(gaps.sum()))
+        indices = np.cumsum(gaps, dtype=int) - 1
+        array[indices] = self._values()
         return array
 
     def __len__(self):
         return len(self._window)
     
     def __getitem__(self, index):
-        return self._window[index]
+        return self._values()[index]
 
     def __str__(self):
-        return str(self._window) + " " + str(self._interarrivals)
+        return str(self._values()) + " " + str(self._gaps())
     
     @property
     def window(self):
-        return self._window.__deepcopy__(None)
+        return self._values().copy()
 
     def insert(self, value, timestamp):
         return NotImplementedError
 
 
 class SlidingWindow(Window):
+    """
+    Fixed-capacity window backed by a preallocated ring buffer.
+
+    Every value is written twice (at i and i + capacity) so the window contents are always
+    available as a contiguous, chronologically ordered view. The mean and sum of squared
+    deviations are maintained with Welford updates (add on insert, remove on eviction) and
+    the interarrival total as a running sum, so insert, mean, std, cov and
+    average_interdemand_interval are O(1). The running moments are recomputed exactly
+    whenever the buffer wraps around or its contents are replaced, which bounds drift.
+
+    The window also tracks the simple exponential smoothing levels of the demand sizes and
+    interarrivals that Croston's method fits over to_array(), so croston_forecast is O(1) too.
+    Evicting the oldest of n observations from such a fit moves its level by
+    (1 - alpha)^(n - 1) * (x_1 - x_0), so the levels follow the window without refitting.
+    """
     def __init__(self, capacity):
-        super().__init__(min_observations=capacity)
         self._capacity = capacity
+        self._croston_decay = (1 - CROSTON_ALPHA) ** (capacity - 1)
+        self._buffer = np.empty(2 * capacity)
+        self._interarrival_buffer = np.empty(2 * capacity)
+        super().__init__(min_observations=capacity)
+
+    def clear(self):
+        self._version += 1
+        self._start = 0
+        self._size = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._interarrival_sum = 0.0
+        self._demand_level = 0.0
+        self._interval_level = 0.0
+        self._last_arrival = None
+
+    def _values(self):
+        return self._buffer[self._start:self._start + self._size]
+
+    def _gaps(self):
+        return self._interarrival_buffer[self._start:self._start + self._size]
+
+    def _recompute(self):
+        values = self._values()
+        self._mean = values.mean() if self._size > 0 else 0.0
+        self._m2 = np.sum((values - self._mean) ** 2) if self._size > 0 else 0.0
+        self._interarrival_sum = self._gaps().sum()
+        self._demand_level = _smoothed_level(values)
+        self._interval_level = _smoothed_level(self._gaps())
+
+    def sum(self):
+        return np.float64(self._mean * self._size) if self._size > 0 else np.float64(0.0)
+
+    def mean(self):
+        return np.float64(self._mean) if self._size > 0 else np.float64(np.nan)
+
+    def std(self):
+        return np.sqrt(np.float64(max(self._m2, 0.0) / self._size)) if self._size > 0 else np.float64(np.nan)
+
+    def average_interdemand_interval(self, timestamp):
+        if self._last_arrival is None: return np.nan
+        return np.float64((self._interarrival_sum + (timestamp - self._last_arrival)) / (self._size + 1))
+
+    def croston_forecast(self):
+        """
+        One-step Croston SBA forecast for to_array(), equal to statsforecast.models.CrostonSBA
+        up to floating point rounding.
+        """
+        if self._size == 0: return np.nan
+        if self._size == 1:
+            # statsforecast forecasts a single observation as itself
+            demand, interval = self._values()[0], self._gaps()[0]
+        else:
+            demand, interval = self._demand_level, self._interval_level
+        return np.float64(demand / interval if interval != 0 else demand) * CROSTON_SBA_FACTOR
+
+    def replace(self, values):
+        values = np.asarray(values, dtype=float)
+        assert values.size == self._size
+        self._version += 1
+        positions = (self._start + np.arange(self._size)) % self._capacity
+        self._buffer[positions] = self._buffer[positions + self._capacity] = values
+        self._recompute()
+
+    def __len__(self):
+        return self._size
 
     def insert(self, value, timestamp):
         assert value != 0
         assert self._last_arrival is None or timestamp > self._last_arrival, f"{timestamp} <= {self._last_arrival}"
 
-        self._window = np.append(self._window, value)
-        self._interarrivals = np.append(self._interarrivals, timestamp - self._last_arrival if self._last_arrival is not None else self._capacity)
+        interarrival = timestamp - self._last_arrival if self._last_arrival is not None else self._capacity
         self._last_arrival = timestamp
+        self._version += 1
+
+        if self._size == self._capacity:
+            evicted = self._buffer[self._start]
+            evicted_interarrival = self._interarrival_buffer[self._start]
+            self._interarrival_sum -= evicted_interarrival
+            self._start += 1
+            self._size -= 1
+            if self._size > 0:
+                delta = evicted - self._mean
+                self._mean -= delta / self._size
+                self._m2 -= delta * (evicted - self._mean)
+                self._demand_level += self._croston_decay * (self._buffer[self._start] - evicted)
+                self._interval_level += self._croston_decay * (self._interarrival_buffer[self._start] - evicted_interarrival)
+            else:
+                self._mean, self._m2 = 0.0, 0.0
+
+            if self._start == self._capacity:
+                # the second half already mirrors the first; rewind to it
+                self._start = 0
+
+        position = (self._start + self._size) % self._capacity
+        self._buffer[position] = self._buffer[position + self._capacity] = value
+        self._interarrival_buffer[position] = self._interarrival_buffer[position + self._capacity] = interarrival
+        self._size += 1
+        self._interarrival_sum += interarrival
+
+        delta = value - self._mean
+        self._mean += delta / self._size
+        self._m2 += delta * (value - self._mean)
+
+        if self._size == 1:
+            self._demand_level, self._interval_level = value, interarrival
+        self._demand_level = _smooth(self._demand_level, value)
+        self._interval_level = _smooth(self._interval_level, interarrival)
+
+        if self._start == 0 and position == self._capacity - 1:
+            self._recompute()
+
 
-        if self._window.size > self._capacity: self._window = np.delete(self._window, 0)
-        if self._interarrivals.size > self._capacity: self._interarrivals = np.delete(self._interarrivals, 0)
+def _smooth(level, value):
+    return CROSTON_ALPHA * value + (1 - CROSTON_ALPHA) * level
+
+
+def _smoothed_level(values):
+    # simple exponential smoothing initialized at the first observation, as in statsforecast
+    if values.size == 0: return 0.0
+    level = values[0]
+    for value in values.tolist(): level = _smooth(level, value)
+    return level
 
 
 class ExpandingWindow(Window):
@@ -127,6 +319,7 @@ class ExpandingWindow(Window):
         super().__init__()
 
     def insert(self, value):
+        self._version += 1
         self._window = np.append(self._window, value)
 
 
@@ -138,8 +331,11 @@ class EfficiencyRatio(ExpandingWindow):
         return net_change / total_change
 
 
+# statsforecast reference for SlidingWindow.croston_forecast
 class CrostonSBA:
     def __init__(self, window: np.array):
+        import statsforecast.models
+
         self._window = window
         self._sba = statsforecast.models.CrostonSBA()
 
@@ -148,15 +344,26 @@ class CrostonSBA:
         
 
 class AnomalyDetector(ABC):
+    # attributes that make up the detection state carried from one day to the next
+    _STATE = ("_window", "_active_anomaly", "_intermittent_demand_anomaly", "_efficiency_ratio", "_min_score",
+              "_forecast", "_previous_value", "_previous_threshold", "_previous_demand_pattern",
+              "_processed", "_scaling_factor")
+
     def __init__(self, window, min_residual=1, efficiency=0.05):
         self._window = SlidingWindow(window)
-        self.croston = None
         self._active_anomaly = False
         self._intermittent_demand_anomaly = False
         self._efficiency_ratio = EfficiencyRatio()
         self._min_residual = min_residual
         self._efficiency = efficiency
         self._always_compute_threshold = True
+        # values carried over from the previous day, so detection can continue from any row
+        self._forecast = 0
+        self._previous_value = np.nan
+        self._previous_threshold = np.nan
+        self._previous_demand_pattern = DemandCategorization.NONE
+        self._processed = 0
+        self._scaling_factor = 1
     
     @abstractmethod
     def score(self, value):
@@ -165,23 +372,30 @@ class AnomalyDetector(ABC):
     @abstractmethod
     def threshold(self, initial_guess):
         return NotImplementedError
+
+    def state(self):
+        """Detection state after the last processed day; restore it with load_state to resume()."""
+        return {attribute: getattr(self, attribute) for attribute in self._STATE}
+
+    def load_state(self, state):
+        for attribute in self._STATE: setattr(self, attribute, state[attribute])
+        # a loaded window can be at the version a fit was cached for, so drop fits of the old one
+        self._fitted_version = None
     
     def anomalies(self, impact_threshold=0):
-        points_over_threshold = self.annotated_series.filter(pl.col("anomaly"))
-        groups = [list(group) for group in consecutive_groups(points_over_threshold["index"])]
-        
-        def group_to_anomaly(group):
-            collective_anomaly = self.annotated_series[group]
-            start_date, end_date = collective_anomaly[[0, -1], "date"]
-            peak = collective_anomaly[collective_anomaly["value"].arg_max(), "date"]
-            score = collective_anomaly[0, "score"]
-            residual = collective_anomaly[0, "residual"]
-            impact_factor = collective_anomaly["value"].sum() - collective_anomaly["threshold"].sum()
-            return (start_date, end_date, peak, score, residual, impact_factor) #if impact_factor >= impact_threshold else None
-        
-        anomalies = [anomaly for group in groups if (anomaly := group_to_anomaly(group)) is not None]
-
-        df = pl.DataFrame(anomalies, schema=["start", "end", "peak", ("score", float), ("residual", float), ("impact", float)], orient="row")
+        # consecutive anomalous days form one collective anomaly: number the runs of the anomaly
+        # column and aggregate each anomalous run in a single pass
+        df = (self.annotated_series
+              .with_columns(pl.col("anomaly").rle_id().alias("run"))
+              .filter(pl.col("anomaly"))
+              .group_by("run", maintain_order=True)
+              .agg(pl.col("date").first().alias("start"),
+                   pl.col("date").last().alias("end"),
+                   pl.col("date").get(pl.col("value").arg_max()).alias("peak"),
+                   pl.col("score").first().cast(pl.Float64),
+                   pl.col("residual").first().cast(pl.Float64),
+                   (pl.col("value").sum() - pl.col("threshold").sum()).cast(pl.Float64).alias("impact"))
+              .drop("run"))
         #global_min = self.annotated_series["value"].min()
         global_max = self.annotated_series["value"].max()
 
@@ -200,17 +414,38 @@ class AnomalyDetector(ABC):
         return df
 
     def run(self, series: pl.DataFrame):
-        self.annotated_series = series.clone().with_row_index().with_columns(
-            pl.lit(False).alias("anomaly"),
-            pl.lit(np.nan).alias("score"),
-            pl.lit(np.nan).alias("residual"),
-            pl.lit(np.nan).alias("threshold"),
-            pl.lit(np.nan).alias("min_score"),
-            pl.lit(np.nan).alias("cov2"),
-            pl.lit(np.nan).alias("adi"),
-            pl.lit(DemandCategorization.NONE).alias("demand_pattern"))
-        
-        for idx, (date, value) in enumerate(series.iter_rows()):
+        values = series["value"].cast(pl.Float64).to_numpy()
+        columns = self._detect(values, 0)
+        self.annotated_series = self._annotate(series, columns, 0)
+        return self.annotated_series
+
+    def resume(self, series: pl.DataFrame, annotated: pl.DataFrame):
+        """
+        Continue detection after the rows processed by an earlier run() or resume() and append the
+        new rows to annotated, the annotated series returned for those earlier rows. series must be
+        the full series, extending the one processed before. Raises ValueError if the normalization
+        of the full series no longer matches the one annotated was produced with; run() over the
+        full series from a fresh detector in that case.
+        """
+        offset = self._processed
+        if annotated.height != offset:
+            raise ValueError(f"{annotated.height} annotated rows, {offset} processed")
+        if self._normalization(series) != self._scaling_factor:
+            raise ValueError(f"normalization changed from {self._scaling_factor} to {self._normalization(series)}")
+
+        values = series["value"].cast(pl.Float64).to_numpy()
+        columns = self._detect(values, offset)
+        self.annotated_series = pl.concat([annotated, self._annotate(series, columns, offset)])
+        return self.annotated_series
+
+    def _detect(self, values, offset):
+        """Run detection over values[offset:] from the current state, returning their output columns."""
+        (anomaly_column, score_column, residual_column, threshold_column, min_score_column,
+         cov2_column, adi_column, demand_pattern_column) = columns = self._output_columns(values.size - offset)
+
+        for idx, value in enumerate(values[offset:].tolist(), start=offset):
+            row = idx - offset
+            previous_value, self._previous_value = self._previous_value, value
             if idx < self._window._min_observations:
                 if value > 0: self._window.insert(value, idx + 1)
                 continue
@@ -221,19 +456,19 @@ class AnomalyDetector(ABC):
 
             score = 0 if not self._active_anomaly else np.inf
             residual = 0 if not self._active_anomaly else np.inf
+            previous_demand_categorization = self._previous_demand_pattern
 
             # don't recategorize demand in middle of anomaly
-            demand_categorization = self._window.classify_demand(idx) if not self._active_anomaly else DemandCategorization(self.annotated_series[idx - 1, "demand_pattern"])
+            demand_categorization = self._window.classify_demand(idx) if not self._active_anomaly else previous_demand_categorization
             
             if value > 0 and demand_categorization in (DemandCategorization.NONE, DemandCategorization.LUMPY, DemandCategorization.INTERMITTENT):
-                if not self._active_anomaly:
-                    self.croston = CrostonSBA(self._window.to_array())
-                
-                forecast = 0 if len(self._window) == 0 else self.croston.forecast()
-                residual = value - forecast
+                # the window does not change during an anomaly, so neither does the forecast
+                self._forecast = 0 if len(self._window) == 0 else self._window.croston_forecast()
+                residual = value - self._forecast
             elif value > 0 and demand_categorization in (DemandCategorization.SMOOTH, DemandCategorization.ERRATIC):
-                if self.annotated_series[idx - 1, "demand_pattern"] in (DemandCategorization.LUMPY, DemandCategorization.INTERMITTENT): # DemandCategorization.NONE,
-                    self._window._window = winsorize(self._window._window, limits=(0, 0.05))
+                if previous_demand_categorization in (DemandCategorization.LUMPY, DemandCategorization.INTERMITTENT): # DemandCategorization.NONE,
+                    from scipy.stats.mstats import winsorize
+                    self._window.replace(winsorize(self._window.window, limits=(0, 0.05)))
                 score = self.score(value)
             
             # min residual cannot be 0 when using >=
@@ -246,8 +481,8 @@ class AnomalyDetector(ABC):
             if new_anomaly:
                 #pl.DataFrame(self._window.to_array()).write_csv(f"{date}.csv")
                 self._intermittent_demand_anomaly = demand_categorization in (DemandCategorization.NONE, DemandCategorization.LUMPY, DemandCategorization.INTERMITTENT)
-                threshold = self.threshold(value) if not self._intermittent_demand_anomaly else forecast + self._min_residual
-                self._efficiency_ratio.insert(self.annotated_series[idx - 1, "value"])
+                threshold = self.threshold(value) if not self._intermittent_demand_anomaly else self._forecast + self._min_residual
+                self._efficiency_ratio.insert(previous_value)
             if self._active_anomaly: 
                 self._efficiency_ratio.insert(value)
 
@@ -266,62 +501,103 @@ class AnomalyDetector(ABC):
                 # smoothing during Croston's method, so don't need to flatten
                 if not self._intermittent_demand_anomaly:
                     # if anomaly in smooth window, rescale
-                    self._window._window = ((self._window.window - self._window.mean()) / self._window.window.std()) * target_std + target_mean
+                    self._window.replace(((self._window.window - self._window.mean()) / self._window.window.std()) * target_std + target_mean)
                 elif new_normal:
                     anomaly_mean = anomaly.mean()
-                    self._window._window = self._window.window * (target_mean / anomaly_mean)
+                    self._window.scale(target_mean / anomaly_mean)
                 
                 self._intermittent_demand_anomaly = False
                 self._efficiency_ratio.clear()
 
-            self.annotated_series[idx, "anomaly"] = self._active_anomaly
-            self.annotated_series[idx, "score"] = score
-            self.annotated_series[idx, "residual"] = residual
+            anomaly_column[row] = self._active_anomaly
+            score_column[row] = score
+            residual_column[row] = residual
             if new_anomaly:
-                self.annotated_series[idx, "threshold"] = threshold
+                threshold_column[row] = threshold
             elif self._active_anomaly:
-                self.annotated_series[idx, "threshold"] = self.annotated_series[idx - 1, "threshold"]
+                threshold_column[row] = self._previous_threshold
             elif self._always_compute_threshold:
-                self.annotated_series[idx, "threshold"] = self.threshold(value)
-            else:
-                self.annotated_series[idx, "threshold"] = np.nan
-            self.annotated_series[idx, "min_score"] = self._min_score
-            self.annotated_series[idx, "cov2"] = self._window.cov() ** 2 if (not self._active_anomaly) or new_anomaly else self.annotated_series[idx, "cov2"]
-            self.annotated_series[idx, "adi"] = self._window.average_interdemand_interval(idx) if (not self._active_anomaly) or new_anomaly else self.annotated_series[idx, "adi"]
-            self.annotated_series[idx, "demand_pattern"] = str(demand_categorization)
+                threshold_column[row] = self.threshold(value)
+            min_score_column[row] = self._min_score
+            if (not self._active_anomaly) or new_anomaly:
+                cov2_column[row] = np.square(self._window.cov())
+                adi_column[row] = self._window.average_interdemand_interval(idx)
+            demand_pattern_column[row] = DEMAND_CODES[demand_categorization]
+            self._previous_threshold = threshold_column[row]
+            self._previous_demand_pattern = demand_categorization
 
             if not self._active_anomaly and value > 0: self._window.insert(value, idx + 1)
 
-
-        # normalization
-        max_value = self.annotated_series["value"].max()
-        scaling_factor = max_value / 100 if max_value > 100 else 1
+        self._processed = values.size
+        return columns
+
+    @staticmethod
+    def _output_columns(n):
+        # results are accumulated in preallocated columns and assembled into a frame once at the end;
+        # demand patterns are stored as codes into DEMAND_CATEGORIES
+        return (np.zeros(n, dtype=bool),
+                np.full(n, np.nan),
+                np.full(n, np.nan),
+                np.full(n, np.nan),
+                np.full(n, np.nan),
+                np.full(n, np.nan),
+                np.full(n, np.nan),
+                np.full(n, DEMAND_CODES[DemandCategorization.NONE], dtype=np.int8))
+
+    @staticmethod
+    def _normalization(series):
+        max_value = series["value"].max()
+        return max_value / 100 if max_value > 100 else 1
+
+    def _annotate(self, series, columns, offset):
+        anomaly, score, residual, threshold, min_score, cov2, adi, demand_pattern = columns
+        annotated_series = series.slice(offset).with_row_index(offset=offset).with_columns(
+            pl.Series("anomaly", anomaly),
+            pl.Series("score", score),
+            pl.Series("residual", residual),
+            pl.Series("threshold", threshold),
+            pl.Series("min_score", min_score),
+            pl.Series("cov2", cov2),
+            pl.Series("adi", adi),
+            pl.Series("demand_pattern", DEMAND_PATTERNS[demand_pattern]))
+
+        # normalization over the whole series; min_residual stays in input units so detection can resume
+        scaling_factor = self._normalization(series)
 
         if scaling_factor > 1:
             # Scale relevant columns
             for col in ["value", "residual", "threshold"]:
-                if col in self.annotated_series.columns:
-                    self.annotated_series = self.annotated_series.with_columns(
+                if col in annotated_series.columns:
+                    annotated_series = annotated_series.with_columns(
                         (pl.col(col) / scaling_factor).alias(col)
                     )
-            
-            # Scale internal min_residual threshold
-            self._min_residual /= scaling_factor
-                    
-        return self.annotated_series
+
+        self._scaling_factor = scaling_factor
+        return annotated_series
 
 
 class ChebyshevInequality(AnomalyDetector):
-    def __init__(self, window=60, z=3, k=6, min_residual=1, efficiency=0.05):
+    def __init__(self, window=60, z=3, k=6, min_residual=1, efficiency=0.05, normality=NormalityTest.SHAPIRO, compiled=True):
         super().__init__(window, min_residual=min_residual, efficiency=efficiency)
         self.z = z
         self.k = k
+        # test choosing between z (normal window) and k (Chebyshev bound); jarque-bera is a cheaper approximation
+        self.normality = NormalityTest(normality)
+        # use the kernel in lib.detection_kernel when numba is available; it gives the same output as AnomalyDetector._detect
+        self.compiled = compiled
         self._min_score = np.inf
 
+    def _detect(self, values, offset):
+        from lib import detection_kernel
+
+        if not self.compiled or not detection_kernel.AVAILABLE:
+            return super()._detect(values, offset)
+        return detection_kernel.detect(self, values, offset)
+
     def score(self, x):
         mu = self._window.mean()
         sigma = self._window.std()
-        self._min_score = self.z if self._window.normality() else self.k
+        self._min_score = self.z if self._window.normality(test=self.normality) else self.k
         return (x - mu) / sigma
     
     def threshold(self, initial_guess):
@@ -352,35 +628,98 @@ class MedianMethod(AnomalyDetector):
 class IsolationForest(AnomalyDetector):
     def __init__(self, window, min_score=0.8, min_residual=1, efficiency=0.05):
         super().__init__(window, min_residual=min_residual, efficiency=efficiency)
+        import isotree
+
         self._iforest = isotree.IsolationForest(ntrees=10, categ_cols=None, nthreads=1)
+        self._fitted_version = None
         self._min_score = min_score
 
+    def _fit(self):
+        # the forest is fit on the window alone and reused until the window changes,
+        # so threshold() only evaluates candidate values against it
+        if self._fitted_version != self._window._version:
+            self._iforest.fit(self._window.window.reshape(-1, 1))
+            self._fitted_version = self._window._version
+
     def score(self, value):
         try:
-            scores = self._iforest.fit_predict(pl.DataFrame(np.append(self._window.window, value)))
-            return scores[-1] if value > self._window.mean() else 0
+            self._fit()
+            score = self._iforest.predict(np.array([[value]], dtype=float))[0]
+            return score if value > self._window.mean() else 0
         except ValueError:
             return np.nan
         
     def threshold(self, initial_guess):
+        from scipy.optimize import minimize_scalar
+
         threshold = minimize_scalar(lambda x: np.abs(self.score(x) - self._min_score), bounds=(self._window.mean(), initial_guess)).x
         return threshold if not np.isclose(threshold, initial_guess) else self._window.mean()
 
 
 class LocalOutlierFactor(AnomalyDetector):
+    """
+    Local outlier factor of a candidate among the window, as sklearn.neighbors.LocalOutlierFactor(p=1)
+    fit on the window plus the candidate gives it, computed directly on the line. The distances from
+    each window point to the others, sorted, are kept per window state; a candidate can then only
+    push the farthest of a point's k neighbours out, so every k-distance and reachability density
+    follows from one column of distances to it.
+
+    Where two points are equally far from a point as its k-th neighbour, sklearn keeps whichever its
+    partial sort happens to leave in place; here the earlier one is kept, which can move that score.
+    """
     def __init__(self, window, min_score=1, min_residual=1, efficiency=0.05):
         super().__init__(window, min_residual=min_residual, efficiency=efficiency)
-        self._lof = sklearn.neighbors.LocalOutlierFactor(n_neighbors=window - 1, p=1)
+        self._n_neighbors = window - 1
+        self._fitted_version = None
         self._min_score = min_score
 
+    def _fit(self):
+        if self._fitted_version != self._window._version:
+            points = self._window.window
+            if not np.isfinite(points).all():
+                raise ValueError("window has non-finite values")
+            distances = np.abs(points[:, None] - points[None, :])
+            np.fill_diagonal(distances, np.inf)
+            # the other points of each point by distance, earlier points first among equal distances
+            # (the point itself sorts last and is cut off)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :-1]
+            self._points = points
+            self._neighbors = order
+            self._neighbor_distances = np.take_along_axis(distances, order, axis=1)
+            self._fitted_version = self._window._version
+
+    def _local_outlier_factor(self, value):
+        self._fit()
+        points, m = self._points, self._points.size
+        if m == 0 or not np.isfinite(value):
+            raise ValueError("no window to score against")
+        # as sklearn, with the candidate as sample m of m + 1
+        k = max(1, min(self._n_neighbors, m))
+        to_candidate = np.abs(points - value)
+
+        # a window point keeps its k nearest other points unless the candidate is closer than the k-th
+        distances = np.concatenate([self._neighbor_distances, np.full((m, 1), np.inf)], axis=1)[:, :k].copy()
+        neighbors = np.concatenate([self._neighbors, np.full((m, 1), m)], axis=1)[:, :k].copy()
+        closer = to_candidate < distances[:, -1]
+        distances[closer, -1], neighbors[closer, -1] = to_candidate[closer], m
+        candidate_neighbors = np.argsort(to_candidate, kind="stable")[:k]
+
+        k_distances = np.append(distances.max(axis=1), to_candidate[candidate_neighbors[-1]])
+        reach = np.maximum(distances, k_distances[neighbors])
+        candidate_reach = np.maximum(to_candidate[candidate_neighbors], k_distances[candidate_neighbors])
+        # sklearn's 1e-10 keeps duplicated points finite
+        densities = np.append(1 / (reach.mean(axis=1) + 1e-10), 1 / (candidate_reach.mean() + 1e-10))
+        return np.mean(densities[candidate_neighbors] / densities[m])
+
     def score(self, value):
         try:
-            self._lof.fit_predict(pl.DataFrame(np.append(self._window.window, value)))
-            scores = np.abs(self._lof.negative_outlier_factor_)
-            return scores[-1] if value > self._window.mean() else 1
+            score = self._local_outlier_factor(value)
+            return score if value > self._window.mean() else 1
         except ValueError:
             return np.nan
         
     def threshold(self, initial_guess):
+        from scipy.optimize import minimize_scalar
+
         threshold = minimize_scalar(lambda x: np.abs(self.score(x) - self._min_score), bounds=(self._window.mean(), initial_guess)).x
         return threshold if not np.isclose(threshold, initial_guess) else self._window.mean()
@@ -0,0 +1,414 @@
+"""
+Compiled fast path for ChebyshevInequality._detect.
+
+The kernel runs the same state machine as AnomalyDetector._detect (sliding window maintenance, demand
+classification, score/threshold, efficiency-ratio return to normal and rescaling) over a float array
+in a single call. It works in place on the buffers of the detector's lib.detection.SlidingWindow and
+EfficiencyRatio, with their scalar state and the detector's carried-over state packed into flat
+vectors by detect(), so a detector can move freely between the compiled and Python paths and resume
+from a saved state on either. Steps that rely on SciPy or NumPy reductions (Shapiro-Wilk,
+winsorizing, rescaling, moment recomputation and the efficiency ratio) fall back to Python through
+numba's object mode and call exactly what the Python path calls, so the output is bit-for-bit
+identical to it.
+
+numba is optional; AVAILABLE is False when it cannot be imported and callers should fall back to
+AnomalyDetector._detect.
+"""
+import numpy as np
+
+from lib.detection import (CROSTON_ALPHA, CROSTON_SBA_FACTOR, DEMAND_CATEGORIES, DEMAND_CODES, NormalityTest,
+                           shapiro_normality, jarque_bera_normality)
+
+try:
+    from numba import njit, objmode
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+# layout of the sliding window state vector
+START, SIZE, MEAN, M2, INTERARRIVAL_SUM, LAST_ARRIVAL, DEMAND_LEVEL, INTERVAL_LEVEL, CROSTON_DECAY, VERSION = range(10)
+STATE_SIZE = 10
+
+# layout of the detector state vector
+ACTIVE_ANOMALY, INTERMITTENT_ANOMALY, MIN_SCORE, FORECAST, PREVIOUS_VALUE, PREVIOUS_THRESHOLD, PREVIOUS_DEMAND, EFFICIENCY_SIZE = range(8)
+DETECTOR_STATE_SIZE = 8
+
+# codes into lib.detection.DEMAND_CATEGORIES
+ERRATIC, LUMPY, SMOOTH, INTERMITTENT, NONE = range(5)
+
+
+def _moments(values):
+    mean = values.mean()
+    return mean, np.sum((values - mean) ** 2)
+
+
+def _winsorized(values):
+    from scipy.stats.mstats import winsorize
+
+    return np.asarray(winsorize(values, limits=(0, 0.05)), dtype=float)
+
+
+def _rescaled(values, mean, target_std, target_mean):
+    return ((values - mean) / values.std()) * target_std + target_mean
+
+
+def _efficiency_ratio(values):
+    if values.size <= 1: return np.nan
+    return (values[-1] - values[0]) / np.sum(np.abs(np.diff(values)))
+
+
+if AVAILABLE:
+    _jarque_bera_normality = njit(cache=True)(jarque_bera_normality)
+
+    @njit(cache=True)
+    def _clear(state):
+        state[VERSION] += 1
+        state[START] = 0
+        state[SIZE] = 0
+        state[MEAN] = 0.0
+        state[M2] = 0.0
+        state[INTERARRIVAL_SUM] = 0.0
+        state[LAST_ARRIVAL] = np.nan
+        state[DEMAND_LEVEL] = 0.0
+        state[INTERVAL_LEVEL] = 0.0
+
+    @njit(cache=True)
+    def _smooth(level, value):
+        return CROSTON_ALPHA * value + (1 - CROSTON_ALPHA) * level
+
+    @njit(cache=True)
+    def _smoothed_level(values):
+        if values.size == 0: return 0.0
+        level = values[0]
+        for value in values: level = _smooth(level, value)
+        return level
+
+    @njit(cache=True)
+    def _view(buffer, state):
+        start = int(state[START])
+        return buffer[start:start + int(state[SIZE])]
+
+    # each object mode block lives in its own function; numba fails to compile several of them
+    # inside the branches of one loop
+
+    @njit(cache=True)
+    def _jit_moments(values):
+        with objmode(mean="float64", m2="float64"):
+            mean, m2 = _moments(values)
+        return mean, m2
+
+    @njit(cache=True)
+    def _jit_normality(values):
+        with objmode(normal="boolean"):
+            normal = bool(shapiro_normality(values))
+        return normal
+
+    @njit(cache=True)
+    def _jit_winsorized(values):
+        with objmode(winsorized="float64[:]"):
+            winsorized = _winsorized(values)
+        return winsorized
+
+    @njit(cache=True)
+    def _jit_rescaled(values, mean, target_std, target_mean):
+        with objmode(rescaled="float64[:]"):
+            rescaled = _rescaled(values, mean, target_std, target_mean)
+        return rescaled
+
+    @njit(cache=True)
+    def _jit_efficiency_ratio(values):
+        with objmode(ratio="float64"):
+            ratio = _efficiency_ratio(values)
+        return ratio
+
+    @njit(cache=True)
+    def _jit_mean(values):
+        with objmode(mean="float64"):
+            mean = values.mean()
+        return mean
+
+    @njit(cache=True)
+    def _recompute(buffer, interarrival_buffer, state):
+        values = _view(buffer, state)
+        if values.size > 0:
+            state[MEAN], state[M2] = _jit_moments(values)
+        else:
+            state[MEAN] = 0.0
+            state[M2] = 0.0
+        state[INTERARRIVAL_SUM] = _view(interarrival_buffer, state).sum()
+        state[DEMAND_LEVEL] = _smoothed_level(values)
+        state[INTERVAL_LEVEL] = _smoothed_level(_view(interarrival_buffer, state))
+
+    @njit(cache=True)
+    def _replace(buffer, interarrival_buffer, state, values, capacity):
+        state[VERSION] += 1
+        start = int(state[START])
+        for i in range(values.size):
+            position = (start + i) % capacity
+            buffer[position] = values[i]
+            buffer[position + capacity] = values[i]
+        _recompute(buffer, interarrival_buffer, state)
+
+    @njit(cache=True)
+    def _insert(buffer, interarrival_buffer, state, value, timestamp, capacity):
+        if np.isnan(state[LAST_ARRIVAL]):
+            interarrival = float(capacity)
+        else:
+            interarrival = timestamp - state[LAST_ARRIVAL]
+        state[LAST_ARRIVAL] = timestamp
+        state[VERSION] += 1
+
+        start = int(state[START])
+        size = int(state[SIZE])
+        if size == capacity:
+            evicted = buffer[start]
+            evicted_interarrival = interarrival_buffer[start]
+            state[INTERARRIVAL_SUM] -= evicted_interarrival
+            start += 1
+            size -= 1
+            if size > 0:
+                delta = evicted - state[MEAN]
+                state[MEAN] -= delta / size
+                state[M2] -= delta * (evicted - state[MEAN])
+                state[DEMAND_LEVEL] += state[CROSTON_DECAY] * (buffer[start] - evicted)
+                state[INTERVAL_LEVEL] += state[CROSTON_DECAY] * (interarrival_buffer[start] - evicted_interarrival)
+            else:
+                state[MEAN] = 0.0
+                state[M2] = 0.0
+
+            if start == capacity:
+                start = 0
+
+        position = (start + size) % capacity
+        buffer[position] = value
+        buffer[position + capacity] = value
+        interarrival_buffer[position] = interarrival
+        interarrival_buffer[position + capacity] = interarrival
+        size += 1
+        state[START] = start
+        state[SIZE] = size
+        state[INTERARRIVAL_SUM] += interarrival
+
+        delta = value - state[MEAN]
+        state[MEAN] += delta / size
+        state[M2] += delta * (value - state[MEAN])
+
+        if size == 1:
+            state[DEMAND_LEVEL] = value
+            state[INTERVAL_LEVEL] = interarrival
+        state[DEMAND_LEVEL] = _smooth(state[DEMAND_LEVEL], value)
+        state[INTERVAL_LEVEL] = _smooth(state[INTERVAL_LEVEL], interarrival)
+
+        if start == 0 and position == capacity - 1:
+            _recompute(buffer, interarrival_buffer, state)
+
+    @njit(cache=True)
+    def _mean(state):
+        return state[MEAN] if state[SIZE] > 0 else np.nan
+
+    @njit(cache=True)
+    def _std(state):
+        return np.sqrt(max(state[M2], 0.0) / state[SIZE]) if state[SIZE] > 0 else np.nan
+
+    @njit(cache=True)
+    def _cov(state):
+        return _std(state) / _mean(state) if state[SIZE] > 0 else np.nan
+
+    @njit(cache=True)
+    def _average_interdemand_interval(state, timestamp):
+        if np.isnan(state[LAST_ARRIVAL]): return np.nan
+        return (state[INTERARRIVAL_SUM] + (timestamp - state[LAST_ARRIVAL])) / (state[SIZE] + 1)
+
+    @njit(cache=True)
+    def _croston_forecast(buffer, interarrival_buffer, state):
+        if state[SIZE] == 0: return np.nan
+        if state[SIZE] == 1:
+            start = int(state[START])
+            demand, interval = buffer[start], interarrival_buffer[start]
+        else:
+            demand, interval = state[DEMAND_LEVEL], state[INTERVAL_LEVEL]
+        return (demand / interval if interval != 0 else demand) * CROSTON_SBA_FACTOR
+
+    @njit(cache=True)
+    def _classify_demand(state, timestamp):
+        cov_squared = np.square(_cov(state))
+        adi = _average_interdemand_interval(state, timestamp)
+
+        if adi <= 1.32 and cov_squared > 0.49: return ERRATIC
+        elif adi > 1.32 and cov_squared > 0.49: return LUMPY
+        elif adi <= 1.32 and cov_squared <= 0.49: return SMOOTH
+        elif adi > 1.32 and cov_squared <= 0.49: return INTERMITTENT
+        return NONE
+
+    @njit(cache=True, error_model="numpy")
+    def chebyshev_kernel(values, offset, buffer, interarrival_buffer, state, efficiency_buffer, detector_state,
+                         jarque_bera, z, k, min_residual, efficiency,
+                         anomaly_out, score_out, residual_out, threshold_out,
+                         min_score_out, cov2_out, adi_out, demand_out):
+        """
+        Run the ChebyshevInequality detector over values[offset:], continuing from the window
+        (buffer, interarrival_buffer, state) and detector state (efficiency_buffer, detector_state)
+        and updating both in place. The per-day columns of the annotated series are written into
+        the preallocated *_out arrays (demand_out holds demand codes). jarque_bera selects the
+        approximate normality test over Shapiro-Wilk; either verdict is cached until the window
+        changes.
+        """
+        capacity = buffer.size // 2
+
+        efficiency_size = int(detector_state[EFFICIENCY_SIZE])
+        active_anomaly = detector_state[ACTIVE_ANOMALY] != 0
+        intermittent_demand_anomaly = detector_state[INTERMITTENT_ANOMALY] != 0
+        min_score = detector_state[MIN_SCORE]
+        forecast = detector_state[FORECAST]
+        previous_value = detector_state[PREVIOUS_VALUE]
+        previous_threshold = detector_state[PREVIOUS_THRESHOLD]
+        previous_demand = int(detector_state[PREVIOUS_DEMAND])
+        normal = False
+        normality_version = -1.0
+        threshold = np.nan
+
+        for idx in range(offset, values.size):
+            row = idx - offset
+            value = values[idx]
+            last_value, previous_value = previous_value, value
+            if idx < capacity:
+                if value > 0: _insert(buffer, interarrival_buffer, state, value, idx + 1, capacity)
+                continue
+
+            interarrival = idx - state[LAST_ARRIVAL] if not np.isnan(state[LAST_ARRIVAL]) else -1.0
+            if not active_anomaly and interarrival >= capacity:
+                _clear(state)
+
+            score = 0.0 if not active_anomaly else np.inf
+            residual = 0.0 if not active_anomaly else np.inf
+
+            # don't recategorize demand in middle of anomaly
+            demand = _classify_demand(state, idx) if not active_anomaly else previous_demand
+
+            if value > 0 and (demand == NONE or demand == LUMPY or demand == INTERMITTENT):
+                forecast = 0.0 if state[SIZE] == 0 else _croston_forecast(buffer, interarrival_buffer, state)
+                residual = value - forecast
+            elif value > 0 and (demand == SMOOTH or demand == ERRATIC):
+                if previous_demand == LUMPY or previous_demand == INTERMITTENT:
+                    _replace(buffer, interarrival_buffer, state, _jit_winsorized(_view(buffer, state).copy()), capacity)
+
+                mu = _mean(state)
+                sigma = _std(state)
+                if state[VERSION] != normality_version:
+                    normality_version = state[VERSION]
+                    window = _view(buffer, state)
+                    normal = _jarque_bera_normality(window, 0.05) if jarque_bera else _jit_normality(window)
+                min_score = z if normal else k
+                score = (value - mu) / sigma
+
+            # min residual cannot be 0 when using >=
+            new_anomaly = not active_anomaly and (score >= min_score or residual >= min_residual)
+            return_to_normal = active_anomaly and (score < min_score or residual < min_residual or abs(value) <= 1e-08)
+            new_normal = active_anomaly and _jit_efficiency_ratio(efficiency_buffer[:efficiency_size]) < efficiency
+
+            active_anomaly = (new_anomaly or active_anomaly) and not (return_to_normal or new_normal)
+
+            if new_anomaly:
+                intermittent_demand_anomaly = demand == NONE or demand == LUMPY or demand == INTERMITTENT
+                threshold = _mean(state) + min_score * _std(state) if not intermittent_demand_anomaly else forecast + min_residual
+                efficiency_buffer[efficiency_size] = last_value
+                efficiency_size += 1
+            if active_anomaly:
+                efficiency_buffer[efficiency_size] = value
+                efficiency_size += 1
+
+            if new_normal or return_to_normal:
+                anomaly = efficiency_buffer[1:efficiency_size]
+                target_mean = _mean(state) if return_to_normal else value
+                target_std = _std(state)
+
+                if intermittent_demand_anomaly and new_normal:
+                    _clear(state)
+                    state[LAST_ARRIVAL] = idx - anomaly.size
+
+                for i in range(anomaly.size):
+                    _insert(buffer, interarrival_buffer, state, anomaly[i], idx - anomaly.size + i + 1, capacity)
+
+                if not intermittent_demand_anomaly:
+                    rescaled = _jit_rescaled(_view(buffer, state).copy(), _mean(state), target_std, target_mean)
+                    _replace(buffer, interarrival_buffer, state, rescaled, capacity)
+                elif new_normal:
+                    anomaly_mean = _jit_mean(anomaly)
+                    _replace(buffer, interarrival_buffer, state, np.multiply(_view(buffer, state), target_mean / anomaly_mean), capacity)
+
+                intermittent_demand_anomaly = False
+                efficiency_size = 0
+
+            anomaly_out[row] = active_anomaly
+            score_out[row] = score
+            residual_out[row] = residual
+            if new_anomaly:
+                threshold_out[row] = threshold
+            elif active_anomaly:
+                threshold_out[row] = previous_threshold
+            else:
+                threshold_out[row] = _mean(state) + min_score * _std(state)
+            min_score_out[row] = min_score
+            if (not active_anomaly) or new_anomaly:
+                cov2_out[row] = np.square(_cov(state))
+                adi_out[row] = _average_interdemand_interval(state, idx)
+            demand_out[row] = demand
+            previous_threshold = threshold_out[row]
+            previous_demand = demand
+
+            if not active_anomaly and value > 0: _insert(buffer, interarrival_buffer, state, value, idx + 1, capacity)
+
+        detector_state[EFFICIENCY_SIZE] = efficiency_size
+        detector_state[ACTIVE_ANOMALY] = active_anomaly
+        detector_state[INTERMITTENT_ANOMALY] = intermittent_demand_anomaly
+        detector_state[MIN_SCORE] = min_score
+        detector_state[FORECAST] = forecast
+        detector_state[PREVIOUS_VALUE] = previous_value
+        detector_state[PREVIOUS_THRESHOLD] = previous_threshold
+        detector_state[PREVIOUS_DEMAND] = previous_demand
+
+
+def detect(detector, values, offset):
+    """
+    Run chebyshev_kernel for a lib.detection.ChebyshevInequality over values[offset:], moving the
+    detector's state in and out of the kernel's flat vectors. Returns the same columns as
+    AnomalyDetector._detect.
+    """
+    window = detector._window
+    state = np.array([window._start, window._size, window._mean, window._m2, window._interarrival_sum,
+                      np.nan if window._last_arrival is None else window._last_arrival,
+                      window._demand_level, window._interval_level, window._croston_decay, window._version],
+                     dtype=float)
+
+    # room for every remaining day plus the day before the anomaly
+    efficiency_ratio = detector._efficiency_ratio
+    efficiency_buffer = np.empty(efficiency_ratio._window.size + values.size - offset + 1)
+    efficiency_buffer[:efficiency_ratio._window.size] = efficiency_ratio._window
+    detector_state = np.array([detector._active_anomaly, detector._intermittent_demand_anomaly, detector._min_score,
+                               detector._forecast, detector._previous_value, detector._previous_threshold,
+                               DEMAND_CODES[detector._previous_demand_pattern], efficiency_ratio._window.size],
+                              dtype=float)
+
+    columns = detector._output_columns(values.size - offset)
+    chebyshev_kernel(values, offset, window._buffer, window._interarrival_buffer, state, efficiency_buffer,
+                     detector_state, detector.normality == NormalityTest.JARQUE_BERA, detector.z, detector.k,
+                     detector._min_residual, detector._efficiency, *columns)
+
+    window._start, window._size, window._version = int(state[START]), int(state[SIZE]), int(state[VERSION])
+    window._mean, window._m2, window._interarrival_sum = state[MEAN], state[M2], state[INTERARRIVAL_SUM]
+    window._last_arrival = None if np.isnan(state[LAST_ARRIVAL]) else int(state[LAST_ARRIVAL])
+    window._demand_level, window._interval_level = state[DEMAND_LEVEL], state[INTERVAL_LEVEL]
+
+    efficiency_size = int(detector_state[EFFICIENCY_SIZE])
+    if efficiency_size != efficiency_ratio._window.size:
+        efficiency_ratio._version += 1
+    efficiency_ratio._window = efficiency_buffer[:efficiency_size].copy()
+    detector._active_anomaly = bool(detector_state[ACTIVE_ANOMALY])
+    detector._intermittent_demand_anomaly = bool(detector_state[INTERMITTENT_ANOMALY])
+    detector._min_score = detector_state[MIN_SCORE]
+    detector._forecast = detector_state[FORECAST]
+    detector._previous_value = detector_state[PREVIOUS_VALUE]
+    detector._previous_threshold = detector_state[PREVIOUS_THRESHOLD]
+    detector._previous_demand_pattern = DEMAND_CATEGORIES[int(detector_state[PREVIOUS_DEMAND])]
+    detector._processed = values.size
+    return columns
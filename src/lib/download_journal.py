@@ -0,0 +1,158 @@
+"""
+Journal of the window downloads into an output directory.
+
+get_gt_data records every window it plans in <output_dir>/download_journal.sqlite as pending, and
+marks it done once its request succeeded, along with the row count and first and last date of the
+stored window, or failed otherwise. With --resume, a window counts as downloaded only if the journal
+has it done and the stored window still has that row count and date range - and, for the final
+window of a run, whose current month keeps filling in, only on the day it was downloaded. A run
+restarted after a crash or quota exhaustion therefore sends only the requests still missing.
+Processes of the process fetcher each open their own connection to the same file.
+"""
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+
+from lib import storage
+
+JOURNAL_FILE = "download_journal.sqlite"
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS windows (
+    dest TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    country_code TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    drop_last INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    rows INTEGER,
+    first_date TEXT,
+    last_date TEXT,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (dest, fname)
+)
+"""
+
+# a window planned with another query than the journaled one starts over as pending
+RECORD = """
+INSERT INTO windows (dest, fname, country_code, topic, start_date, end_date, drop_last, status, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?)
+ON CONFLICT (dest, fname) DO UPDATE SET
+    country_code = excluded.country_code, topic = excluded.topic, start_date = excluded.start_date,
+    end_date = excluded.end_date, drop_last = excluded.drop_last, status = 'pending', failures = 0,
+    rows = NULL, first_date = NULL, last_date = NULL, updated = excluded.updated
+WHERE country_code != excluded.country_code OR topic != excluded.topic OR start_date != excluded.start_date
+    OR end_date != excluded.end_date OR drop_last != excluded.drop_last
+"""
+
+
+def window_extent(dest, fname):
+    """(rows, first date, last date) of a stored window; (0, None, None) if it is empty or was never written."""
+    try:
+        dates, _ = storage.read_window(dest, fname)
+    except FileNotFoundError:
+        return 0, None, None
+    if len(dates) == 0:
+        return 0, None, None
+    return len(dates), str(np.datetime64(dates[0], "D")), str(np.datetime64(dates[-1], "D"))
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class DownloadJournal:
+    """The journal of the windows downloaded into `directory`, keyed by their directory relative to it and name."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL_FILE)
+        self._connection = None
+
+    def __getstate__(self):
+        # a connection can't be pickled into a worker process, which opens its own
+        return {"directory": self.directory, "path": self.path, "_connection": None}
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # the async fetcher journals from its writer thread while the connection was opened on the main one;
+            # the two never use it at the same time
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(SCHEMA)
+        return self._connection
+
+    def key(self, request):
+        return os.path.relpath(request.dest, self.directory), request.fname
+
+    def _latest(self, requests):
+        # a window listed twice is written by its last request, as in lib.request_plan
+        return {self.key(request): request for request in requests}
+
+    def record(self, requests):
+        """Add the planned windows that are not journaled yet as pending."""
+        now = _now()
+        with self.connection as connection:
+            connection.executemany(RECORD, [(*key, r.country_code, r.topic, r.start_date_str, r.end_date_str, int(r.drop_last), now)
+                                            for key, r in self._latest(requests).items()])
+
+    def completed(self, requests):
+        """
+        (dest, fname) of the requests journaled done whose stored window still has the journaled rows
+        and date range; windows that changed since, and final windows done before today, are set back
+        to pending.
+        """
+        journaled = {(dest, fname): ((rows, first_date, last_date), updated[:10]) for dest, fname, rows, first_date, last_date, updated
+                     in self.connection.execute("SELECT dest, fname, rows, first_date, last_date, updated FROM windows WHERE status = ?", (DONE,))}
+        today = datetime.date.today().isoformat()
+        completed, changed = set(), []
+        for key, request in self._latest(requests).items():
+            if key not in journaled:
+                continue
+            extent, day = journaled[key]
+            if window_extent(request.dest, request.fname) == extent and (not request.drop_last or day == today):
+                completed.add((request.dest, request.fname))
+            else:
+                changed.append(key)
+
+        with self.connection as connection:
+            connection.executemany("UPDATE windows SET status = ?, updated = ? WHERE dest = ? AND fname = ?",
+                                   [(PENDING, _now(), *key) for key in changed])
+        return completed
+
+    def mark_done(self, requests):
+        """Journal the windows of finished requests as done, with the extent of what was stored."""
+        now = _now()
+        with self.connection as connection:
+            connection.executemany("UPDATE windows SET status = ?, rows = ?, first_date = ?, last_date = ?, updated = ? "
+                                   "WHERE dest = ? AND fname = ?",
+                                   [(DONE, *window_extent(r.dest, r.fname), now, *self.key(r)) for r in requests])
+
+    def mark_failed(self, requests):
+        now = _now()
+        with self.connection as connection:
+            connection.executemany("UPDATE windows SET status = ?, failures = failures + 1, updated = ? WHERE dest = ? AND fname = ?",
+                                   [(FAILED, now, *self.key(r)) for r in requests])
+
+    def counts(self, dest=None):
+        """Number of journaled windows by status, of every directory or only of dest (relative to the journal's)."""
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        if dest is None:
+            counts.update(self.connection.execute("SELECT status, COUNT(*) FROM windows GROUP BY status"))
+        else:
+            counts.update(self.connection.execute("SELECT status, COUNT(*) FROM windows WHERE dest = ? GROUP BY status", (dest,)))
+        return counts
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -3,9 +3,12 @@ import time
 import os
 import secrets
 import string
+import typing
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
+from lib.storage import CSV, write_window, drop_last_row
+
 DATE_FORMAT_MONTH = "%Y-%m"
 DATE_FORMAT = "%Y-%m-%d"
 
@@ -14,7 +17,8 @@ VPN_GT_TOPIC_CODE = "/m/012t0g"
 SERVER = 'https://trends.googleapis.com'
 API_VERSION = 'v1beta'
 DISCOVERY_URL_SUFFIX = '/$discovery/rest?version=' + API_VERSION
-DISCOVERY_URL = SERVER + DISCOVERY_URL_SUFFIX
+# DISCOVERY_URL in the environment points the downloader at another server, such as trends_standin.py
+DISCOVERY_URL = os.environ.get("DISCOVERY_URL", SERVER + DISCOVERY_URL_SUFFIX)
 
 CURRENT_DATE_STR = datetime.date.today().strftime("%Y-%m-%d")
 
@@ -22,12 +26,17 @@ def generate_random_string(length=20):
     characters = string.ascii_lowercase + string.digits
     return ''.join(secrets.choice(characters) for _ in range(length))
 
+def is_rate_limited(error):
+    resp = getattr(error, "resp", None)
+    if getattr(resp, "status", None) == 429:
+        return True
+    return len(error.args) > 1 and '"code": 429' in str(error.args[1])
+
 def error_check(logger, error, delay=60):
     logger.error(error.args)
-    if len(error.args) > 1:
-        if '"code": 429' in str(error.args[1]):
-            logger.error(f"HTTPError: Ran out of queries to the Google Trends API, initiating {delay} sec sleep")
-            time.sleep(delay)
+    if is_rate_limited(error):
+        logger.error(f"HTTPError: Ran out of queries to the Google Trends API, initiating {delay} sec sleep")
+        time.sleep(delay)
     return 0
 
 def tlvl_gparse(graph, dest, fname):
@@ -40,28 +49,53 @@ def tlvl_gparse(graph, dest, fname):
     else:
         return 0
 
-def get_multi_timeline(service, logger, dest,fname, start_date_str, end_date_str, country_code, topic: str = VPN_GT_TOPIC_CODE, attempts=10):
+def timeline_terms(topic):
     # append a random string to force api refresh
     random_str = generate_random_string(20)
-    topics = f"{topic} + {random_str} + {topic.upper()}"
+    return f"{topic} + {random_str} + {topic.upper()}"
+
+def write_timeline(dest, fname, response, storage=CSV):
+    if(len(response) > 0):
+        datanorm = response['lines'][0]['points']
+        data = pd.json_normalize(datanorm)
+        write_window(dest, fname, data, storage)
+
+def get_multi_timeline(service, logger, dest,fname, start_date_str, end_date_str, country_code, topic: str = VPN_GT_TOPIC_CODE, attempts=10, storage=CSV, copies=()):
+    # copies: further (dest, fname) the same response is written to
+    topics = timeline_terms(topic)
     for i in range(attempts):
         try:
             graph = service.getGraph(terms=topics, 
                                      restrictions_startDate=start_date_str, restrictions_endDate=end_date_str, 
                                      restrictions_geo=country_code)
             response = graph.execute()
-            if(len(response) > 0):
-                datanorm = response['lines'][0]['points']
-                data = pd.json_normalize(datanorm)
-                data.to_csv(os.path.join(dest,fname),index=False)
-            return
+            if len(response) == 0:
+                # nothing to write; a journaled window stays failed, so a resumed run asks again
+                logger.warning(f"Empty response for {country_code} with start date {start_date_str} and end date {end_date_str}")
+                return False
+            for copy_dest, copy_fname in [(dest, fname), *copies]:
+                write_timeline(copy_dest, copy_fname, response, storage)
+            return True
         except Exception as error:
             error_check(logger, error, (i + 1) * 61)
     time.sleep(1)
-    logger.critical(f"Unable to retrieve multiTimeline file for {country_code} with start date {start_date_str} and end date {end_date_str}")     
+    logger.critical(f"Unable to retrieve multiTimeline file for {country_code} with start date {start_date_str} and end date {end_date_str}")
+    return False     
 
-def get_multi_timeline_windows(service, logger, dest, start_date_str, window_s_str,
-end_date_str, country_code, topic=VPN_GT_TOPIC_CODE, window=8, overlap=1):
+class WindowRequest(typing.NamedTuple):
+    """One getGraph call of a window download and the file it is written to."""
+    dest: str
+    fname: str
+    start_date_str: str
+    end_date_str: str
+    country_code: str
+    topic: str = VPN_GT_TOPIC_CODE
+    # the final window of a run loses its last (incomplete) day once written
+    drop_last: bool = False
+
+def multi_timeline_requests(dest, start_date_str, window_s_str, end_date_str, country_code,
+                            topic=VPN_GT_TOPIC_CODE, window=8, overlap=1):
+    """The window and coarse requests of get_multi_timeline_windows, in download order."""
     start_datetime = datetime.datetime.strptime(start_date_str, '%Y-%m')
     end_datetime = datetime.datetime.strptime(end_date_str, '%Y-%m')
     today = datetime.datetime.strptime(CURRENT_DATE_STR, DATE_FORMAT)
@@ -85,29 +119,47 @@ end_date_str, country_code, topic=VPN_GT_TOPIC_CODE, window=8, overlap=1):
         window_e_str = window_end.strftime(DATE_FORMAT_MONTH)
         fname =  "{0}_multiTimeline.csv".format(window_s_str)
         
-        
-        get_multi_timeline(service, logger, dest, fname, window_s_str, 
-                           window_e_str, country_code, topic)
-        
-            
-        get_multi_timeline(service, logger, dest, 
-                            f"{window_s_str}_coarseMultiTimeline.csv", start_date_str, window_e_str, 
+        yield WindowRequest(dest, fname, window_s_str, window_e_str, country_code, topic, drop_last=done)
+        yield WindowRequest(dest, f"{window_s_str}_coarseMultiTimeline.csv", start_date_str, window_e_str,
                             country_code, topic)
 
         window_start += relativedelta(months=(window - overlap))
 
-
         if done:
-            # delete the last day of data
-            file_path = os.path.join(dest, fname)
-            if os.path.exists(file_path):
-                try:
-                    df = pd.read_csv(file_path)
-                    if len(df) > 0:
-                        df = df.iloc[:-1]
-                        df.to_csv(file_path, index=False)
-                        logger.info(f"Removed last row from final window file: {file_path}")
-                except Exception as e:
-                    logger.warning(f"Failed to clean last row of {file_path}: {e}")
             break
-   
\ No newline at end of file
+
+def drop_final_row(logger, dest, fname, storage=CSV):
+    # delete the last day of data
+    try:
+        if drop_last_row(dest, fname, storage):
+            logger.info(f"Removed last row from final window file: {os.path.join(dest, fname)}")
+    except Exception as e:
+        logger.warning(f"Failed to clean last row of {os.path.join(dest, fname)}: {e}")
+
+def get_multi_timeline_windows(service, logger, dest, start_date_str, window_s_str,
+end_date_str, country_code, topic=VPN_GT_TOPIC_CODE, window=8, overlap=1, storage=CSV):
+    for request in multi_timeline_requests(dest, start_date_str, window_s_str, end_date_str, country_code,
+                                           topic, window, overlap):
+        get_multi_timeline(service, logger, request.dest, request.fname, request.start_date_str,
+                           request.end_date_str, request.country_code, request.topic, storage=storage)
+        if request.drop_last:
+            drop_final_row(logger, request.dest, request.fname, storage)
+
+def get_multi_timeline_queries(service, logger, queries, storage=CSV, journal=None):
+    """
+    Download the PlannedQuerys of lib.request_plan in order, each written to all of its windows, and
+    journal their outcome in the DownloadJournal if given.
+    """
+    for query in queries:
+        first, *rest = query.requests
+        downloaded = get_multi_timeline(service, logger, first.dest, first.fname, query.start_date_str, query.end_date_str,
+                                        query.country_code, query.topic, storage=storage,
+                                        copies=[(request.dest, request.fname) for request in rest])
+        # a window that was not written again keeps the day it lost last time
+        for request in query.requests:
+            if request.drop_last and downloaded:
+                drop_final_row(logger, request.dest, request.fname, storage)
+        if journal is not None and downloaded:
+            journal.mark_done(query.requests)
+        elif journal is not None:
+            journal.mark_failed(query.requests)
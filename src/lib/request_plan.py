@@ -0,0 +1,93 @@
+"""
+Planning of the getGraph requests of a download run.
+
+All WindowRequests of a run are listed before anything is sent, so that the API quota goes only to
+windows the run still needs: a window requested twice is downloaded once (the later request wins, as
+it would overwrite the earlier file), a window already stored in its directory is not downloaded
+again unless it is the final window of a run, whose current month keeps filling in, and windows
+whose queries are identical - the first window and first coarse window of a run starting at its
+start month cover the same range - are written from a single response.
+
+Coarse windows of consecutive windows overlap but end in different months, so each is normalized
+differently and stays a request of its own.
+"""
+import collections
+import os
+import typing
+
+from lib import storage
+from lib.google_trends_utils import WindowRequest
+
+
+class PlannedQuery(typing.NamedTuple):
+    """One getGraph call and the windows its response is written to."""
+    country_code: str
+    topic: str
+    start_date_str: str
+    end_date_str: str
+    requests: typing.Tuple[WindowRequest, ...]
+
+
+class RequestPlan(typing.NamedTuple):
+    queries: typing.List[PlannedQuery]
+    # windows listed for the run
+    planned: int
+    # listed again later in the run
+    superseded: int
+    # stored in their directory already (journaled done, with a journal)
+    on_disk: int
+    # written from the response of another window's identical query
+    shared: int
+
+    @property
+    def cost(self):
+        """getGraph requests the plan sends, not counting retries."""
+        return len(self.queries)
+
+    def summary(self):
+        return (f"{self.planned} windows planned: {self.superseded} requested twice, {self.on_disk} already downloaded, "
+                f"{self.shared} sharing an identical query; {self.cost} requests to send")
+
+
+def stored_windows(dest):
+    """Names of the windows stored in a sample/country directory, in either layout."""
+    if not os.path.isdir(dest):
+        return set()
+    return set(storage.window_files(dest, coarse=False) + storage.window_files(dest, coarse=True))
+
+
+def plan_requests(requests: typing.Iterable[WindowRequest], redownload=False, completed=None) -> RequestPlan:
+    """
+    Plan the requests of a run. completed holds the (dest, fname) known to be downloaded (see
+    lib.download_journal); without it, any window stored on disk is, except the final window of a run
+    (drop_last), which is always downloaded again. With redownload, all windows are downloaded again.
+    """
+    requests = list(requests)
+
+    # a window listed twice is written by its last request
+    latest = {}
+    for request in requests:
+        latest[(request.dest, request.fname)] = request
+    superseded = len(requests) - len(latest)
+
+    stored = {}
+    wanted = []
+    for request in latest.values():
+        if not redownload and completed is not None:
+            if (request.dest, request.fname) in completed:
+                continue
+        elif not redownload and not request.drop_last:
+            if request.dest not in stored:
+                stored[request.dest] = stored_windows(request.dest)
+            if request.fname in stored[request.dest]:
+                continue
+        wanted.append(request)
+    on_disk = len(latest) - len(wanted)
+
+    queries = collections.defaultdict(list)
+    for request in wanted:
+        queries[(request.dest, request.country_code, request.topic, request.start_date_str, request.end_date_str)].append(request)
+
+    planned = [PlannedQuery(country_code, topic, start_date_str, end_date_str, tuple(group))
+               for (_, country_code, topic, start_date_str, end_date_str), group in queries.items()]
+    return RequestPlan(planned, len(requests), superseded, on_disk, len(wanted) - len(planned))
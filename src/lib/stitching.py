@@ -5,8 +5,10 @@ import pandas as pd
 import numpy as np
 import sys
 import datetime
+from multiprocessing import shared_memory
 
 #from .stitching_lib import *
+from lib import storage
 
 sys.path.append(os.path.abspath('.'))
 
@@ -23,26 +25,285 @@ def combine_stitched_dfs_intersection(dfs: typing.List[pd.DataFrame],
                                       value_column: str = "value",
                                       use_mean: bool = True,
                                       nonzero_fraction = 1) -> pd.DataFrame:
-
-    # Define a function to apply to each date group
-    def value_conditionally(group):
-        nonzero_values = group[group > 0]
-        if len(nonzero_values) >= len(group) * nonzero_fraction:  # Check if all values are greater than 0
-            # If yes, return the average or median value
-            return nonzero_values.mean() if use_mean else nonzero_values.median()
-        else:
-            return 0  # Otherwise, return 0
-
+    """
+    Combine samples of the same window by date: the mean (or median) of the nonzero values on a date if
+    at least nonzero_fraction of the values on that date are nonzero, otherwise 0.
+    """
     # Concatenate the list of DataFrames into one DataFrame
-    combined_df = pd.concat(dfs)
-
-    # Group by date
-    grouped = combined_df.groupby(date_column)[value_column]
-
-    # Apply the function to each date group and aggregate the results
-    max_values = grouped.apply(value_conditionally).reset_index(name=value_column)
-
-    return max_values
+    combined_df = pd.concat(dfs, ignore_index=True)
+
+    # Number the dates in sorted order; missing dates are dropped, as by groupby
+    codes, dates = pd.factorize(combined_df[date_column], sort=True)
+    combined = combine_by_date(codes, combined_df[value_column].to_numpy(dtype=float), len(dates),
+                               use_mean, nonzero_fraction)
+
+    return pd.DataFrame({date_column: dates, value_column: combined})
+
+
+def combine_by_date(codes, values, n_dates, use_mean=True, nonzero_fraction=1) -> np.ndarray:
+    """
+    combine_stitched_dfs_intersection over values numbered by date (codes, -1 for no date), listed
+    sample by sample.
+    """
+    present = codes >= 0
+    sizes = np.bincount(codes[present], minlength=n_dates)
+
+    # Nonzero values grouped by date, in the order of the samples within each date
+    nonzero = present & (values > 0)
+    nonzero_codes = codes[nonzero]
+    order = np.argsort(nonzero_codes, kind="stable")
+    nonzero_values = values[nonzero][order]
+    counts = np.bincount(nonzero_codes, minlength=n_dates)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    combined = np.zeros(n_dates)
+    conditional = counts >= sizes * nonzero_fraction
+    combined[conditional & (counts == 0)] = np.nan  # mean/median of no values
+    # reduce dates with the same number of nonzero values together, so each date is reduced over a
+    # contiguous row exactly as a Series of its nonzero values would be
+    for count in np.unique(counts[conditional & (counts > 0)]):
+        group = np.flatnonzero(conditional & (counts == count))
+        rows = nonzero_values[offsets[group][:, None] + np.arange(count)]
+        combined[group] = rows.sum(axis=1) / count if use_mean else np.median(rows, axis=1)
+
+    # dates that are all below the nonzero fraction are integer zeros
+    if not conditional.any(): combined = combined.astype(np.int64)
+
+    return combined
+
+
+def sorted_files(dir_path: str, coarse: bool) -> typing.List[str]:
+    return storage.window_files(dir_path, coarse)
+
+
+class SampleWindows:
+    """
+    All samples of one country's windows, read once: values[sample, window, day] on the date axis
+    days[window, day] shared by the samples of a window (the sorted dates of any sample, as integer
+    day offsets). present marks the dates each sample has; windows shorter than the longest are
+    padded at the end.
+
+    share() copies the arrays into shared memory so another process can attach() zero-copy views.
+    """
+    FIELDS = ("values", "present", "days", "lengths")
+
+    def __init__(self, values, present, days, lengths):
+        self.values = values
+        self.present = present
+        self.days = days
+        self.lengths = lengths
+
+    @classmethod
+    def load(cls, sample_dirs: typing.List[str], coarse: bool = False):
+        windows = []
+        for d in sample_dirs:
+            files = storage.read_windows(d, coarse)
+            if windows and len(files) < len(windows[0]):
+                raise IndexError(f"{d} has only {len(files)} windows; need {len(windows[0])}, coarse is set to {coarse}")
+            windows.append([_window_arrays(os.path.join(d, f), *files[f]) for f in list(files)[:len(windows[0]) if windows else None]])
+
+        n_samples, n_windows = len(windows), len(windows[0]) if windows else 0
+        axes = [np.unique(np.concatenate([windows[i][w][0] for i in range(n_samples)])) for w in range(n_windows)]
+        lengths = np.array([axis.size for axis in axes], dtype=int)
+        n_days = lengths.max(initial=0)
+
+        values = np.full((n_samples, n_windows, n_days), np.nan)
+        present = np.zeros(values.shape, dtype=bool)
+        days = np.full((n_windows, n_days), -1, dtype=np.int64)
+        for w, axis in enumerate(axes):
+            days[w, :axis.size] = axis
+            for i in range(n_samples):
+                sample_days, sample_values = windows[i][w]
+                position = np.searchsorted(axis, sample_days)
+                values[i, w, position] = sample_values
+                present[i, w, position] = True
+        return cls(values, present, days, lengths)
+
+    def __len__(self):
+        return self.days.shape[0]
+
+    def share(self) -> dict:
+        """Copy the arrays into new shared memory blocks; returns the descriptor to attach() them by."""
+        descriptor = {}
+        try:
+            for field in self.FIELDS:
+                array = getattr(self, field)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                descriptor[field] = (block.name, array.shape, array.dtype.str)
+                np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+                block.close()
+        except BaseException:
+            self.unlink(descriptor)
+            raise
+        return descriptor
+
+    @classmethod
+    def attach(cls, descriptor: dict):
+        """Windows viewing the shared memory blocks of a descriptor, until detach()."""
+        blocks = [shared_memory.SharedMemory(name=descriptor[field][0]) for field in cls.FIELDS]
+        windows = cls(*(np.ndarray(descriptor[field][1], descriptor[field][2], buffer=block.buf)
+                        for field, block in zip(cls.FIELDS, blocks)))
+        windows._blocks = blocks
+        return windows
+
+    def detach(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        for block in getattr(self, "_blocks", []):
+            block.close()
+
+    @staticmethod
+    def unlink(descriptor: dict):
+        """Free the shared memory blocks of a descriptor."""
+        for name, _, _ in descriptor.values():
+            try:
+                block = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            block.close()
+            block.unlink()
+
+    def combine(self, window, use_mean=True, nonzero_fraction=1):
+        """Days and combined values of a window, as combine_stitched_dfs_intersection of its samples."""
+        length = self.lengths[window]
+        present = self.present[:, window, :length]
+        codes = np.broadcast_to(np.arange(length), present.shape)[present]
+        combined = combine_by_date(codes, self.values[:, window, :length][present], length, use_mean, nonzero_fraction)
+        return self.days[window, :length], combined
+
+    def combined_frame(self, window, use_mean=True, nonzero_fraction=1) -> pd.DataFrame:
+        days, combined = self.combine(window, use_mean, nonzero_fraction)
+        return pd.DataFrame({'date': from_days(days), 'value': combined})
+
+    def standard_error(self) -> np.ndarray:
+        """
+        Standard error of the mean of the samples on each date, zeros included, as [window, day]; nan
+        where fewer than two samples have the date (and on the padding).
+        """
+        n = self.present.sum(axis=0)
+        values = np.where(self.present, self.values, 0.0)
+        mean = values.sum(axis=0) / np.maximum(n, 1)
+        squares = (np.where(self.present, self.values - mean, 0.0) ** 2).sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(n > 1, np.sqrt(squares / (n - 1) / n), np.nan)
+
+    def merged_frame(self, use_mean=True, nonzero_fraction=1) -> pd.DataFrame:
+        """All combined windows as one series by date, each date taken from the first window that has it."""
+        combined = [self.combine(window, use_mean, nonzero_fraction) for window in range(len(self))]
+        days = np.concatenate([days for days, _ in combined])
+        values = np.concatenate([values for _, values in combined])
+        days, first = np.unique(days, return_index=True)
+        return pd.DataFrame({'date': from_days(days), 'value': values[first]})
+
+
+class SampleReducer:
+    """
+    combine_by_date with the mean, folded in one sample of a window at a time: per date the number of
+    samples, the number of nonzero values and their running sum, so memory is O(days in window)
+    however many samples there are.
+
+    The sum replays numpy's pairwise summation (eight lanes over whole blocks of eight values, then
+    the rest in order), so the mean equals combine_by_date's exactly for up to 128 nonzero values per
+    date; beyond that numpy splits the sum recursively and the last bit may differ.
+    """
+    LANES = 8
+
+    def __init__(self, nonzero_fraction=1):
+        self.nonzero_fraction = nonzero_fraction
+        self.start = 0
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.lanes = np.zeros((self.LANES, 0))
+        self.block = np.zeros((self.LANES, 0))
+
+    def _cover(self, low, high):
+        # grow the date axis to include low..high
+        if not self.sizes.size:
+            self.start = low
+        end = self.start + self.sizes.size
+        pad = (max(self.start - low, 0), max(high + 1 - end, 0))
+        if any(pad):
+            self.sizes, self.counts = np.pad(self.sizes, pad), np.pad(self.counts, pad)
+            self.lanes, self.block = (np.pad(a, ((0, 0), pad)) for a in (self.lanes, self.block))
+            self.start -= pad[0]
+
+    def add(self, days, values):
+        """Fold in one sample: its day offsets (unique) and values."""
+        if not days.size:
+            return
+        self._cover(days.min(), days.max())
+        index = days - self.start
+        self.sizes[index] += 1
+
+        nonzero = values > 0
+        index, values = index[nonzero], np.asarray(values[nonzero], dtype=float)
+        lane = self.counts[index] % self.LANES
+        self.counts[index] += 1
+
+        self.block[lane, index] = values
+        full = index[lane == self.LANES - 1]
+        self.lanes[:, full] += self.block[:, full]
+
+    def result(self):
+        """Days and combined values, as combine_by_date with use_mean."""
+        dated = self.sizes > 0
+        days = np.flatnonzero(dated) + self.start
+        sizes, counts = self.sizes[dated], self.counts[dated]
+        lanes, block = self.lanes[:, dated], self.block[:, dated]
+
+        sums = np.where(counts >= self.LANES, ((lanes[0] + lanes[1]) + (lanes[2] + lanes[3])) +
+                                              ((lanes[4] + lanes[5]) + (lanes[6] + lanes[7])), 0.)
+        for lane in range(self.LANES - 1):
+            sums = np.where(lane < counts % self.LANES, sums + block[lane], sums)
+
+        combined = np.zeros(days.size)
+        conditional = counts >= sizes * self.nonzero_fraction
+        combined[conditional & (counts == 0)] = np.nan
+        positive = conditional & (counts > 0)
+        combined[positive] = sums[positive] / counts[positive]
+
+        if not conditional.any(): combined = combined.astype(np.int64)
+        return days, combined
+
+
+class SampleStream(SampleWindows):
+    """
+    SampleWindows that keeps no samples in memory: each combine reads that window from every sample
+    and folds it into a SampleReducer. Only the mean can be combined this way.
+    """
+    def __init__(self, sample_dirs, files):
+        self.sample_dirs = sample_dirs
+        self.files = files
+
+    @classmethod
+    def open(cls, sample_dirs: typing.List[str], coarse: bool = False):
+        files = []
+        for d in sample_dirs:
+            names = storage.window_files(d, coarse)
+            if files and len(names) < len(files[0]):
+                raise IndexError(f"{d} has only {len(names)} windows; need {len(files[0])}, coarse is set to {coarse}")
+            files.append(names[:len(files[0]) if files else None])
+        return cls(sample_dirs, files)
+
+    def __len__(self):
+        return len(self.files[0]) if self.files else 0
+
+    def combine(self, window, use_mean=True, nonzero_fraction=1):
+        if not use_mean:
+            raise ValueError("samples can only be streamed into the mean")
+        reducer = SampleReducer(nonzero_fraction)
+        for d, names in zip(self.sample_dirs, self.files):
+            reducer.add(*_window_arrays(os.path.join(d, names[window]), *storage.read_window(d, names[window])))
+        return reducer.result()
+
+
+def _window_arrays(path, dates, values):
+    days = dates.astype("datetime64[D]")
+    dated = ~np.isnat(days)
+    days, values = days[dated].astype(np.int64), values[dated]
+    if np.unique(days).size != days.size:
+        raise ValueError(f"{path} has duplicate dates")
+    return days, values
 
 
 def group_paths(dirs, slicer):
@@ -70,11 +331,25 @@ def get_med_or_mean(ratios):
         scale = median_ratio
     return scale
 
-def get_merge_percent(df, df_coarse):
-    return (df.merge(df_coarse, how="left", on='date')
-                  .ffill()
-                  .fillna(df_coarse['value'].iloc[0]))["value_y"]
-    
+def to_days(dates) -> np.ndarray:
+    # dates as integer day offsets from the epoch
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+def from_days(days) -> pd.DatetimeIndex:
+    return pd.to_datetime(days, unit="D")
+
+def get_merge_percent(days, coarse_days, coarse_values):
+    # coarse value on each of days, carried forward from the last day that has one and filled with
+    # the first coarse value before that
+    coarse_values = np.asarray(coarse_values, dtype=float)
+    first = coarse_values[0]
+    order = np.argsort(coarse_days, kind="stable")
+    coarse_days, coarse_values = coarse_days[order], coarse_values[order]
+    position = np.minimum(np.searchsorted(coarse_days, days), coarse_days.size - 1)
+    merged = np.where(coarse_days[position] == days, coarse_values[position], np.nan)
+
+    last = np.maximum.accumulate(np.where(np.isnan(merged), -1, np.arange(days.size)))
+    return np.where(last >= 0, merged[np.maximum(last, 0)], first)
 
 def save_windows(df1, df2, df1c, df2c):
     save_dir = "saved_windows_" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -86,45 +361,140 @@ def save_windows(df1, df2, df1c, df2c):
     df1c.to_csv(f"{path}/df1_coarse.csv",index=False)
     df2c.to_csv(f"{path}/df2_coarse.csv",index=False)
 
+def ratio_coarse_scale(days1, values1, days2, values2, overlap_days,
+                       coarse1_days, coarse1_values, coarse2_days, coarse2_values, prefix=0):
+    """
+    Factor that puts the days of window 2 outside overlap_days on the scale of series 1: the median
+    (or mean, if the median is 0) ratio of their nonzero values on the overlap, or, without such
+    ratios, of the coarse series of the two windows over the days of series 1. Returns the factor
+    and the mask of new days in window 2; the factor is None if the new days are all 0 and are
+    appended as they are.
+
+    days1/values1 may be only the tail of series 1, with prefix earlier days left out; the coarse
+    ratio of those days is the ratio of the first coarse values, as long as neither coarse series
+    starts before the tail.
+    """
+    overlap1, overlap2 = np.isin(days1, overlap_days), np.isin(days2, overlap_days)
+    new = ~overlap2
+
+    # overlapping values are paired in order, as the windows share a calendar
+    v1, v2 = values1[overlap1], values2[overlap2]
+    pairs = min(v1.size, v2.size)
+    v1, v2 = np.asarray(v1[:pairs], dtype=float), np.asarray(v2[:pairs], dtype=float)
+    nonzero = (v1 != 0) & (v2 != 0)
+    ratios = v1[nonzero] / v2[nonzero]
+
+    if no_ratio(ratios):
+        if (values2[new] == 0).all():
+            return None, new
+
+        # getting mean/median of coarse series over series 1 and multiplying new portion by reciprocal
+        coarse_overlap_old = get_merge_percent(days1, coarse1_days, coarse1_values)
+        coarse_overlap_new = get_merge_percent(days1, coarse2_days, coarse2_values)
+        coarse_overlap_scaling = np.divide(coarse_overlap_old, coarse_overlap_new,
+                                           out=np.zeros(days1.size), where=coarse_overlap_new != 0)
+        if prefix:
+            if min(coarse1_days.min(), coarse2_days.min()) < days1[0]:
+                raise ValueError("coarse series start before the tail of the stitched series")
+            first_old, first_new = np.full(prefix, float(coarse1_values[0])), np.full(prefix, float(coarse2_values[0]))
+            coarse_overlap_scaling = np.concatenate([np.divide(first_old, first_new, out=np.zeros(prefix), where=first_new != 0),
+                                                     coarse_overlap_scaling])
+        return get_med_or_mean(coarse_overlap_scaling), new
+
+    scale = get_med_or_mean(ratios)
+    assert not (scale == 0 or np.isnan(scale)), f"Scale {scale} is invalid {ratios}"
+    return scale, new
+
 def stitch_two_windows_ratio_coarse(df1: pd.DataFrame,
                              df2: pd.DataFrame,
                              df1_coarse: pd.DataFrame,
                              df2_coarse: pd.DataFrame,
                              overlap: list,
                              write=False) -> pd.DataFrame:
-    df1_values = df1[df1['date'].isin(overlap)]['value']
-    df2_values = df2[df2['date'].isin(overlap)]['value']
-
-    ratios = np.array([v1 / v2 for v1, v2 in zip(df1_values.to_list(), df2_values.to_list()) if v1 != 0 and v2 != 0])
-    new_portion = df2[~df2['date'].isin(overlap)].reset_index(drop=True)
-
     if write:
         save_windows(df1, df2, df1_coarse, df2_coarse)
 
-    if  no_ratio(ratios):
-        if (new_portion['value'] == 0).all():
-            return pd.concat([df1, df2[~df2['date'].isin(overlap)]]).reset_index(drop=True)
-
-        # getting mean/median of coarse series over df1 and multiplying new portion by reciprocal
-        coarse_overlap_old = get_merge_percent(df1, df1_coarse)
-        coarse_overlap_new = get_merge_percent(df1, df2_coarse)
-        coarse_overlap_scaling = [coarse_overlap_old[i]/coarse_overlap_new[i] if coarse_overlap_new[i] != 0 else 0 for i in range(len(df1)) ]
-        co_sfactor = get_med_or_mean(coarse_overlap_scaling)
-
-        new_portion['value'] = new_portion['value']*co_sfactor
-
-        # scaling new region by coarse
-        # new_coarse_scaling = get_merge_percent(new_portion, df2_coarse) / 100
-        # new_portion['value'] = new_portion['value']*new_coarse_scaling
+    scale, new = ratio_coarse_scale(to_days(df1['date']), df1['value'].to_numpy(),
+                                    to_days(df2['date']), df2['value'].to_numpy(),
+                                    to_days(pd.DatetimeIndex(list(overlap))),
+                                    to_days(df1_coarse['date']), df1_coarse['value'].to_numpy(),
+                                    to_days(df2_coarse['date']), df2_coarse['value'].to_numpy())
 
-        return pd.concat([df1, new_portion]).reset_index(drop=True)
-
-    scale = get_med_or_mean(ratios)
-    assert not (scale == 0 or np.isnan(scale)), f"Scale {scale} is invalid {ratios}"
-
-    new_portion['value'] = scale * new_portion['value']
+    new_portion = df2[new].reset_index(drop=True)
+    if scale is not None:
+        new_portion['value'] = scale * new_portion['value']
     return pd.concat([df1, new_portion]).reset_index(drop=True)
 
+class StitchedSeries:
+    """
+    Series stitched window by window into preallocated day/value buffers that grow geometrically,
+    so appending a window costs O(window) instead of copying the whole history as pd.concat does.
+
+    The buffers may hold only the tail of a longer series, with prefix days before it, as long as
+    the windows stitched onto it do not reach back before the tail.
+    """
+    def __init__(self, days, values, capacity=0, prefix=0):
+        values = np.asarray(values)
+        self.prefix = prefix
+        self._dtype = values.dtype
+        self._size = 0
+        self._days = np.empty(max(capacity, days.size), dtype=np.int64)
+        self._values = np.empty(max(capacity, days.size))
+        self.append(days, values)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, capacity=0):
+        return cls(to_days(df['date']), df['value'].to_numpy(), capacity)
+
+    @property
+    def days(self):
+        return self._days[:self._size]
+
+    @property
+    def values(self):
+        return self._values[:self._size]
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __len__(self):
+        return self._size
+
+    def append(self, days, values):
+        values = np.asarray(values)
+        end = self._size + days.size
+        if end > self._days.size:
+            capacity = max(end, 2 * self._days.size)
+            self._days = np.resize(self._days, capacity)
+            self._values = np.resize(self._values, capacity)
+        self._days[self._size:end] = days
+        self._values[self._size:end] = values
+        self._size = end
+        # keep integer series integer, as concatenating frames would
+        self._dtype = np.result_type(self._dtype, values.dtype)
+
+    def stitch_ratio_coarse(self, days, values, coarse1_days, coarse1_values, coarse2_days, coarse2_values):
+        """
+        Array version of stitch_two_windows_ratio_coarse, appending the new days of a window in place.
+        Returns the scale applied to them (None if they were appended as they are).
+        """
+        values = np.asarray(values)
+        if self.prefix and days.size and days.min() < self.days[0]:
+            raise ValueError("window starts before the tail of the stitched series")
+        scale, new = ratio_coarse_scale(self.days, self.values, days, values, np.intersect1d(self.days, days),
+                                        coarse1_days, coarse1_values, coarse2_days, coarse2_values, self.prefix)
+        self.append(days[new], values[new] if scale is None else scale * values[new])
+        return scale
+
+    def tail(self, n_days):
+        """Series of the days within n_days of the last one, with the days before it as prefix."""
+        start = np.searchsorted(self.days, self.days[-1] - n_days, side="right") if self._size else 0
+        return StitchedSeries(self.days[start:], self.values[start:].astype(self._dtype), prefix=self.prefix + start)
+
+    def to_frame(self, start=0) -> pd.DataFrame:
+        return pd.DataFrame({'date': from_days(self.days[start:]), 'value': self.values[start:].astype(self._dtype)})
+
 def combine_window_pair(window_list,index,sample_range):
     if index > 0:
         to_combine = [window_list[i][index-1] for i in sample_range]
@@ -141,47 +511,43 @@ def combine_window_pair(window_list,index,sample_range):
 
     return merge_old, merge_current
 
-def combine_and_stitch(country_samples,write=False):
+NUMPY = "numpy"
+POLARS = "polars"
+ENGINES = (NUMPY, POLARS)
+
+def load_windows(sample_dirs, coarse=False, stream=False, engine=NUMPY) -> SampleWindows:
+    """
+    A country's sample windows, read up front by numpy or by one multi-threaded polars query
+    (lib.stitching_polars) or, with stream, one window at a time as combined.
+    """
+    if stream:
+        return SampleStream.open(sample_dirs, coarse)
+    if engine == POLARS:
+        from lib.stitching_polars import PolarsWindows
+        return PolarsWindows.scan(sample_dirs, coarse)
+    return SampleWindows.load(sample_dirs, coarse)
+
+def combine_and_stitch(country_samples,write=False,stream=False,engine=NUMPY):
     # pass in list of full sample paths for given country
-    csample_merge = []
-    csample_coarse = []
-    for csample_dir in country_samples:
-        directory = csample_dir
-        files = [file for file in sorted(os.listdir(directory)) if file.endswith(".csv")]
-        csample_merge.append([pd.read_csv(os.path.join(directory, file), parse_dates=["date"]) for file in files if
-                            file.endswith("multiTimeline.csv") and "coarse" not in file])
-        
-        coarse_sample = [pd.read_csv(os.path.join(directory, file), parse_dates=["date"]) for file in files if
-                            file.endswith("coarseMultiTimeline.csv")]
-        if (len(coarse_sample)==0):
-            print("[ERROR] run into empty sample list")
-            files = [file for file in sorted(os.listdir(directory)) if file.endswith(".csv")]
-            print(f"[DEBUG] All CSV files in {directory}: {files}")
-
-            coarse_sample_files = [file for file in files if file.endswith("coarseMultiTimeline.csv")]
-            print(f"[DEBUG] Coarse files found: {coarse_sample_files}")
-
-        coarse_sample.insert(0, coarse_sample[0])
-        
-        csample_coarse.append(coarse_sample)
-    
-    
-    sample_range = range(len(country_samples))
+    windows = load_windows(country_samples, coarse=False, stream=stream, engine=engine)
+    coarse_windows = load_windows(country_samples, coarse=True, stream=stream, engine=engine)
+    # the first coarse window stands in for the one before it
+    coarse = [coarse_windows.combine(0)] + [coarse_windows.combine(i) for i in range(len(coarse_windows))]
 
-    _, merged_window = combine_window_pair(csample_merge,0,sample_range)
+    stitched = StitchedSeries(*windows.combine(0), capacity=0 if stream else windows.lengths.sum())
     # starting at 1, processes window_index and window_index-1
     
-    for window_index in range(1, len(csample_merge[0])):
-
-        _, merge_next = combine_window_pair(csample_merge,window_index,sample_range)
-        
-        coarse_old, coarse_next = combine_window_pair(csample_coarse,window_index,sample_range)
+    for window_index in range(1, len(windows)):
+
+        days, values = windows.combine(window_index)
+        (coarse_old_days, coarse_old), (coarse_next_days, coarse_next) = coarse[window_index - 1], coarse[window_index]
+        if write:
+            save_windows(stitched.to_frame(), windows.combined_frame(window_index),
+                         pd.DataFrame({'date': from_days(coarse_old_days), 'value': coarse_old}),
+                         pd.DataFrame({'date': from_days(coarse_next_days), 'value': coarse_next}))
         # call stitch on these..
-        merged_window = stitch_two_windows_ratio_coarse(merged_window, merge_next,
-                                           coarse_old, coarse_next, set(merged_window['date'])&set(merge_next['date']), write=write)
+        stitched.stitch_ratio_coarse(days, values, coarse_old_days, coarse_old, coarse_next_days, coarse_next)
     
     #merged_window['value'] = min_max_normalize(merged_window['value'])
 
-    return merged_window.reset_index(drop=True)
-        
-
+    return stitched.to_frame()
@@ -0,0 +1,135 @@
+"""
+Polars engine for reading and combining a country's sample windows.
+
+All window files of all samples are scanned as one lazy query, so parsing, the per-date grouping
+and the reduction across samples run on every core inside a single country job: the windows are
+numbered, checked and put on their date axes with joins, and each date's samples are reduced with
+one group_by over all windows. Stitching windows onto each other (a sequential dependency, each
+scale depends on the series stitched so far) stays with StitchedSeries.
+"""
+import os
+import typing
+
+import numpy as np
+import polars as pl
+
+from lib import storage
+from lib.stitching import SampleWindows
+
+
+def window_listing(sample_dirs: typing.List[str], coarse: bool) -> pl.DataFrame:
+    """
+    One row per window file used: its path, source (CSV or windows.parquet), name, sample and window
+    number. As in SampleWindows.load, windows are numbered by name within a sample and every sample
+    needs as many windows as the first, of which it uses as many.
+    """
+    rows = []
+    n_windows = None
+    for sample, d in enumerate(sample_dirs):
+        files = storage.window_files(d, coarse)
+        if n_windows is not None and len(files) < n_windows:
+            raise IndexError(f"{d} has only {len(files)} windows; need {n_windows}, coarse is set to {coarse}")
+        n_windows = len(files) if n_windows is None else n_windows
+        source = os.path.join(d, storage.WINDOWS_FILE) if storage.has_windows_file(d) else None
+        rows += [(source or os.path.join(d, file), source is not None, file, sample, window)
+                 for window, file in enumerate(files[:n_windows])]
+    return pl.DataFrame(rows, schema={"path": pl.String, "parquet": pl.Boolean, "file": pl.String,
+                                      "sample": pl.Int64, "window": pl.Int64}, orient="row")
+
+
+def scan_windows(listing: pl.DataFrame) -> pl.LazyFrame:
+    """Every row of the listed windows: its path, date as written and as parsed if ISO, sample, window and value."""
+    frames = []
+    csv = listing.filter(~pl.col("parquet"))
+    if not csv.is_empty():
+        frames.append(pl.scan_csv(csv["path"].to_list(), infer_schema=False, include_file_paths="path")
+                      .select("path", "date", pl.col("value").cast(pl.Float64))
+                      .join(csv.lazy().select("path", "sample", "window"), on="path"))
+    parquet = listing.filter(pl.col("parquet"))
+    if not parquet.is_empty():
+        frames.append(pl.scan_parquet(parquet["path"].unique().to_list(), include_file_paths="path")
+                      .filter(pl.col("file").is_in(parquet["file"].unique().implode()))
+                      .join(parquet.lazy().select("path", "file", "sample", "window"), on=["path", "file"])
+                      .select("path", pl.col("date").cast(pl.String), "value", "sample", "window"))
+    if not frames:
+        return pl.LazyFrame(schema={"path": pl.String, "date": pl.String, "parsed": pl.Date,
+                                    "sample": pl.Int64, "window": pl.Int64, "value": pl.Float64})
+
+    return (pl.concat(frames)
+            .with_columns(pl.col("date").str.slice(0, 10).str.to_date("%Y-%m-%d", strict=False).alias("parsed"))
+            .select("path", "date", "parsed", "sample", "window", "value"))
+
+
+def _parse_days(windows: pl.DataFrame) -> pl.DataFrame:
+    # ISO dates are parsed by polars; anything else goes through the same fallback as the numpy engine
+    unparsed = windows.filter(pl.col("parsed").is_null() & pl.col("date").is_not_null())
+    if not unparsed.is_empty():
+        days = storage.parse_dates(windows["date"].to_numpy())
+    else:
+        days = windows["parsed"].to_numpy()
+    days = days.astype("datetime64[D]")
+    dated = ~np.isnat(days)
+    return (windows.select("path", "sample", "window", "value")
+            .with_columns(pl.Series("day", days.astype(np.int64)))
+            .filter(pl.Series(dated)))
+
+
+def combine_by_day(samples: pl.DataFrame, use_mean=True, nonzero_fraction=1) -> pl.DataFrame:
+    """
+    combine_stitched_dfs_intersection of every window's samples at once: per (window, day), the mean
+    (or median) of the positive values if at least nonzero_fraction of the values are positive, else 0.
+    """
+    positive = pl.col("value").is_not_nan() & (pl.col("value") > 0)
+    nonzero = pl.col("value").filter(positive)
+    return (samples.lazy()
+            .group_by("window", "day")
+            .agg(pl.len().alias("size"), positive.sum().alias("count"),
+                 (nonzero.mean() if use_mean else nonzero.median()).alias("combined"))
+            .select("window", "day",
+                    # the mean/median of no values is nan, as with pandas
+                    pl.when(pl.col("count") >= pl.col("size") * nonzero_fraction)
+                    .then(pl.col("combined").fill_null(np.nan)).otherwise(0.0).alias("value"))
+            .sort("window", "day")
+            .collect())
+
+
+class PolarsWindows(SampleWindows):
+    """
+    SampleWindows read and reduced by polars: samples holds every sample value with its window and
+    day, and the combined axes are the sorted days of any sample within each window.
+    """
+    def __init__(self, samples, n_windows):
+        self.samples = samples
+        axes = samples.select("window", "day").unique().sort("window", "day")
+        self.axis_days = axes["day"].to_numpy()
+        self.bounds = np.searchsorted(axes["window"].to_numpy(), np.arange(n_windows + 1))
+        self.lengths = np.diff(self.bounds)
+        self._combined = {}
+
+    @classmethod
+    def scan(cls, sample_dirs: typing.List[str], coarse: bool = False):
+        listing = window_listing(sample_dirs, coarse)
+        n_windows = listing["window"].max() + 1 if not listing.is_empty() else 0
+
+        windows = _parse_days(scan_windows(listing).collect())
+        duplicated = windows.group_by("path", "sample", "window", "day").len().filter(pl.col("len") > 1)
+        if not duplicated.is_empty():
+            raise ValueError(f"{duplicated['path'][0]} has duplicate dates")
+
+        # a missing value counts as a zero-demand sample of its date, as nan does with numpy
+        return cls(windows.select("window", "day", pl.col("value").fill_null(np.nan)), n_windows)
+
+    def __len__(self):
+        return self.lengths.size
+
+    def combine(self, window, use_mean=True, nonzero_fraction=1):
+        key = (use_mean, nonzero_fraction)
+        if key not in self._combined:
+            self._combined[key] = combine_by_day(self.samples, use_mean, nonzero_fraction)["value"].to_numpy()
+        start, end = self.bounds[window], self.bounds[window + 1]
+        combined = self._combined[key][start:end]
+        # a window whose dates are all below the nonzero fraction is integer zeros, as combine_by_date
+        # gives when reducing it alone
+        if not (combined != 0).any():
+            combined = combined.astype(np.int64)
+        return self.axis_days[start:end], combined
@@ -0,0 +1,226 @@
+"""
+Storage backends for downloaded windows, stitched series and annotated series.
+
+csv is the original layout: one <start>_multiTimeline.csv / <start>_coarseMultiTimeline.csv per
+window in each sample/country directory, and <CC>_stitched.csv, <CC>_coarse_stitched.csv and
+annotated.csv next to their consumers. parquet keeps all windows of a sample/country directory in a
+single windows.parquet (columns file, date, value, where file is the name the window would have as
+a CSV) and writes the series as .parquet files with the same names. Readers accept either layout,
+preferring parquet, so a tree can be migrated (migrate_storage.py) without touching the pipeline
+configuration first.
+"""
+import os
+
+import numpy as np
+import polars as pl
+
+# pandas is imported where it is used: the detection CLI reads series through polars only and
+# should not pay for importing it
+
+CSV = "csv"
+PARQUET = "parquet"
+FORMATS = (CSV, PARQUET)
+
+WINDOWS_FILE = "windows.parquet"
+WINDOW_SCHEMA = {"file": pl.String, "date": pl.Date, "value": pl.Float64}
+
+
+def is_coarse(file):
+    return file.endswith("coarseMultiTimeline.csv")
+
+
+def is_window(file, coarse):
+    return is_coarse(file) if coarse else (file.endswith("multiTimeline.csv") and "coarse" not in file)
+
+
+def replace_file(path, write):
+    # write next to path and move into place, so readers never see a partial file
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+# --- sample windows ----------------------------------------------------------------------------
+
+def _read_windows(directory, columns=None):
+    return pl.read_parquet(os.path.join(directory, WINDOWS_FILE), columns=columns)
+
+
+def has_windows_file(directory):
+    return os.path.isfile(os.path.join(directory, WINDOWS_FILE))
+
+
+def window_files(directory, coarse):
+    """Sorted names of the (coarse) windows in a sample/country directory, in either layout."""
+    if has_windows_file(directory):
+        files = _read_windows(directory, ["file"])["file"].unique().to_list()
+    else:
+        files = os.listdir(directory)
+    return sorted(f for f in files if is_window(f, coarse))
+
+
+def window_sources(directory):
+    """Paths of the files holding the windows of a sample/country directory, in either layout."""
+    if has_windows_file(directory):
+        return [os.path.join(directory, WINDOWS_FILE)]
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if is_window(f, False) or is_window(f, True)]
+
+
+def read_windows(directory, coarse):
+    """Map of window name -> (dates, values) arrays for every (coarse) window of a directory, in name order."""
+    if not has_windows_file(directory):
+        return {f: read_window_csv(os.path.join(directory, f)) for f in window_files(directory, coarse)}
+
+    windows = _read_windows(directory)
+    # the placeholder row of an empty window has no date and is dropped, as if read from an empty CSV
+    groups = {file: (group["date"].drop_nulls().to_numpy(), group.drop_nulls("date")["value"].to_numpy())
+              for (file,), group in windows.group_by("file", maintain_order=True) if is_window(file, coarse)}
+    return {file: groups[file] for file in sorted(groups)}
+
+
+def read_window(directory, file):
+    """(dates, values) of a single window of a sample/country directory, in either layout."""
+    if not has_windows_file(directory):
+        return read_window_csv(os.path.join(directory, file))
+    window = (pl.scan_parquet(os.path.join(directory, WINDOWS_FILE))
+              .filter((pl.col("file") == file) & pl.col("date").is_not_null()).collect())
+    if window.is_empty() and file not in window_files(directory, is_coarse(file)):
+        raise FileNotFoundError(f"{file} not in {os.path.join(directory, WINDOWS_FILE)}")
+    return window["date"].to_numpy(), window["value"].to_numpy()
+
+
+def read_window_csv(path):
+    # polars reads these small files several times faster than pd.read_csv(parse_dates=...)
+    df = pl.read_csv(path, columns=["date", "value"], infer_schema=False)
+    return parse_dates(df["date"].to_numpy()), df["value"].cast(pl.Float64).to_numpy()
+
+
+def parse_dates(dates):
+    try:
+        # ISO dates convert directly
+        return np.asarray(dates, dtype="datetime64[D]")
+    except ValueError:
+        import pandas as pd
+        return pd.to_datetime(dates).to_numpy(dtype="datetime64[D]")
+
+
+def write_window(directory, file, data: "pd.DataFrame", storage=CSV):
+    """Store a downloaded window (columns date, value) as directory/file, replacing an earlier download."""
+    if storage == CSV:
+        data.to_csv(os.path.join(directory, file), index=False)
+        return
+
+    window = window_frame(file, parse_dates(data["date"].to_numpy()), data["value"].to_numpy(dtype=float))
+    _update_windows(directory, lambda windows: pl.concat([windows.filter(pl.col("file") != file), window]))
+
+
+def window_frame(file, dates, values):
+    """Rows of one window for windows.parquet; an empty window keeps a single row without a date."""
+    if len(dates) == 0:
+        return pl.DataFrame({"file": [file], "date": [None], "value": [None]}, schema=WINDOW_SCHEMA)
+    return pl.DataFrame({"file": file, "date": dates, "value": values}, schema=WINDOW_SCHEMA)
+
+
+def add_windows(directory, windows):
+    """Store several windows (file -> frame from window_frame) at once, keeping windows already stored."""
+    new = pl.concat(list(windows.values()))
+    _update_windows(directory, lambda stored: pl.concat([new.filter(~pl.col("file").is_in(stored["file"].unique().implode())), stored]))
+
+
+def drop_last_row(directory, file, storage=CSV):
+    """Remove the last day of a stored window; returns whether there was one to remove."""
+    if storage == CSV:
+        path = os.path.join(directory, file)
+        if not os.path.exists(path): return False
+        import pandas as pd
+        df = pd.read_csv(path)
+        if len(df) == 0: return False
+        df.iloc[:-1].to_csv(path, index=False)
+        return True
+
+    if not has_windows_file(directory): return False
+    windows = _read_windows(directory).with_row_index("row")
+    rows = windows.filter((pl.col("file") == file) & pl.col("date").is_not_null())["row"]
+    if rows.is_empty(): return False
+    if rows.len() == 1:
+        _update_windows(directory, lambda windows: pl.concat([windows.filter(pl.col("file") != file), window_frame(file, [], [])]))
+    else:
+        _update_windows(directory, lambda windows: windows.filter(pl.int_range(pl.len()) != rows.max()))
+    return True
+
+
+def _update_windows(directory, update):
+    path = os.path.join(directory, WINDOWS_FILE)
+    windows = _read_windows(directory) if has_windows_file(directory) else pl.DataFrame(schema=WINDOW_SCHEMA)
+    replace_file(path, update(windows).write_parquet)
+
+
+# --- series ------------------------------------------------------------------------------------
+
+def series_path(stem, storage=CSV):
+    return f"{stem}.{storage}"
+
+
+def find_series(stem):
+    """Path of the stored series stem.parquet or stem.csv, or None."""
+    for storage in (PARQUET, CSV):
+        path = series_path(stem, storage)
+        if os.path.isfile(path): return path
+    return None
+
+
+def read_series(path) -> "pd.DataFrame":
+    """Stitched series as a pandas frame with parsed dates."""
+    import pandas as pd
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+        df["date"] = pd.to_datetime(df["date"])
+        return df
+    # round_trip reads back exactly the floats that were written
+    return pd.read_csv(path, parse_dates=["date"], float_precision="round_trip")
+
+
+def _remove_other_formats(stem, storage):
+    # a series written in one format supersedes any copy in the other
+    for other in FORMATS:
+        if other != storage and os.path.isfile(series_path(stem, other)):
+            os.remove(series_path(stem, other))
+
+
+def write_series(df: "pd.DataFrame", stem, storage=CSV):
+    path = series_path(stem, storage)
+    _remove_other_formats(stem, storage)
+    if storage == CSV:
+        df.to_csv(path, index=False)
+    else:
+        # dates are stored as dates, which polars reads back as pl.Date like a parsed CSV
+        df = df.assign(date=df["date"].dt.date)
+        replace_file(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+    return path
+
+
+def append_series(df: "pd.DataFrame", path):
+    """Add rows to the end of a stored series; a parquet series is rewritten with them."""
+    if path.endswith(".csv"):
+        df.to_csv(path, mode="a", header=False, index=False)
+        return
+    import pandas as pd
+    df = pd.concat([read_series(path), df]).assign(date=lambda df: df["date"].dt.date)
+    replace_file(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+
+def read_frame(path) -> pl.DataFrame:
+    """Series or annotated series as a polars frame with parsed dates."""
+    if path.endswith(".parquet"):
+        return pl.read_parquet(path)
+    return pl.read_csv(path, try_parse_dates=True)
+
+
+def write_frame(df: pl.DataFrame, stem, storage=CSV):
+    path = series_path(stem, storage)
+    _remove_other_formats(stem, storage)
+    if storage == CSV:
+        df.write_csv(path)
+    else:
+        replace_file(path, df.write_parquet)
+    return path
@@ -0,0 +1,218 @@
+"""
+Asyncio engine for downloading Google Trends windows.
+
+All requests of a run share one event loop instead of blocking a worker process each. A single
+token bucket spaces the requests in flight to the configured rate, and the number of requests in
+flight grows while the API keeps answering and halves on every 429 (additive increase,
+multiplicative decrease). A 429 also pauses the whole bucket for a jittered, exponentially growing
+backoff, rather than each worker sleeping (i + 1) * 61 seconds on its own. googleapiclient calls are
+blocking, so they run on a thread pool with one HTTP connection per thread. The windows are written
+and journaled on a single writer thread, exactly as get_multi_timeline writes them, so storing one
+response never holds up the requests of the others.
+"""
+import asyncio
+import collections
+import random
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from lib.google_trends_utils import drop_final_row, is_rate_limited, timeline_terms, write_timeline
+from lib.request_plan import PlannedQuery
+from lib.storage import CSV
+
+RATE = 2.0
+BURST = 5
+CONCURRENCY = 3
+MAX_CONCURRENCY = 16
+BACKOFF = 61.0
+MAX_BACKOFF = 610.0
+ATTEMPTS = 10
+
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff of the attempt-th retry, jittered over its upper half so paused requests don't return together."""
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class TokenBucket:
+    """`rate` requests per second on average and at most `burst` at once, for every coroutine that acquires from it."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # waiters queue on the lock, so tokens are handed out in request order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, delay):
+        """Hold back every request for `delay` seconds and restart from an empty bucket."""
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+        self.tokens = 0
+        self.updated = max(self.updated, self.resume_at)
+
+
+class AdaptiveLimit:
+    """Limit on requests in flight: one more after `limit` successes in a row, half as many after a 429."""
+    def __init__(self, initial, maximum):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, rate_limited):
+        async with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class WindowFetcher:
+    """
+    Downloads PlannedQuerys through a shared TokenBucket and AdaptiveLimit, journals their outcome in
+    the DownloadJournal if given and counts what happened in `stats`.
+    """
+    def __init__(self, service, logger, storage=CSV, rate=RATE, burst=BURST, concurrency=CONCURRENCY,
+                 max_concurrency=MAX_CONCURRENCY, backoff=BACKOFF, max_backoff=MAX_BACKOFF, attempts=ATTEMPTS,
+                 journal=None):
+        self.service = service
+        self.logger = logger
+        self.storage = storage
+        self.journal = journal
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = AdaptiveLimit(concurrency, max_concurrency)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempts = attempts
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        # one thread, so windows sharing a windows.parquet never race and the journal is used by one thread at a time
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.local = threading.local()
+        self.stats = collections.Counter()
+
+    def execute(self, graph):
+        # httplib2 connections are not thread safe, so each pool thread keeps its own
+        if not hasattr(self.local, "http"):
+            from googleapiclient.http import build_http
+            self.local.http = build_http()
+        return graph.execute(http=self.local.http)
+
+    def store(self, query: PlannedQuery, response):
+        """
+        Write a response as each window of its query and journal them done; runs on the writer thread.
+        An empty response writes nothing and journals them failed, so a resumed run asks again.
+        """
+        if len(response) == 0:
+            if self.journal is not None:
+                self.journal.mark_failed(query.requests)
+            return False
+        for request in query.requests:
+            write_timeline(request.dest, request.fname, response, self.storage)
+            if request.drop_last:
+                drop_final_row(self.logger, request.dest, request.fname, self.storage)
+        if self.journal is not None:
+            self.journal.mark_done(query.requests)
+        return True
+
+    async def fetch(self, query: PlannedQuery):
+        """Download one query and store it as each of its windows; returns whether it succeeded within `attempts` tries."""
+        loop = asyncio.get_running_loop()
+        topics = timeline_terms(query.topic)
+        for attempt in range(self.attempts):
+            await self.limit.acquire()
+            rate_limited = False
+            try:
+                await self.bucket.acquire()
+                graph = self.service.getGraph(terms=topics,
+                                              restrictions_startDate=query.start_date_str,
+                                              restrictions_endDate=query.end_date_str,
+                                              restrictions_geo=query.country_code)
+                self.stats["requests"] += 1
+                response = await loop.run_in_executor(self.pool, self.execute, graph)
+                if not await loop.run_in_executor(self.writer, self.store, query, response):
+                    self.stats["empty"] += 1
+                    self.logger.warning(f"Empty response for {query.country_code} with start date {query.start_date_str} "
+                                        f"and end date {query.end_date_str}")
+                    return False
+                self.stats["downloaded"] += 1
+                return True
+            except Exception as error:
+                self.logger.error(error.args)
+                rate_limited = is_rate_limited(error)
+            finally:
+                await self.limit.release(rate_limited)
+
+            self.stats["errors"] += 1
+            if rate_limited:
+                self.stats["rate_limited"] += 1
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                self.logger.error(f"HTTPError: Ran out of queries to the Google Trends API, pausing all requests for {delay:.0f} sec "
+                                  f"(concurrency now {self.limit.limit})")
+                self.bucket.pause(delay)
+            else:
+                await asyncio.sleep(backoff_delay(attempt, 1, 30))
+
+        self.stats["failed"] += 1
+        if self.journal is not None:
+            await loop.run_in_executor(self.writer, self.journal.mark_failed, query.requests)
+        self.logger.critical(f"Unable to retrieve multiTimeline file for {query.country_code} with start date "
+                             f"{query.start_date_str} and end date {query.end_date_str}")
+        return False
+
+    async def fetch_all(self, queries: typing.List[PlannedQuery]):
+        with tqdm(total=len(queries), desc='Request progress') as progress:
+            async def fetch(query):
+                result = await self.fetch(query)
+                progress.update()
+                return result
+            return await asyncio.gather(*(fetch(query) for query in queries))
+
+    def close(self):
+        self.pool.shutdown()
+        self.writer.shutdown()
+
+
+def download_windows(service, logger, queries: typing.List[PlannedQuery], storage=CSV, **options):
+    """Download the planned `queries` on one event loop (options as for WindowFetcher); returns the fetcher's stats."""
+    async def run():
+        # the bucket and limit belong to the loop they are created on
+        fetcher = WindowFetcher(service, logger, storage, **options)
+        try:
+            await fetcher.fetch_all(queries)
+        finally:
+            fetcher.close()
+        return fetcher.stats
+
+    return asyncio.run(run())
@@ -0,0 +1,69 @@
+import os
+import sys
+import argparse
+
+import polars as pl
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from lib import storage
+
+
+def migrate_windows(directory, remove_csv):
+    """Fold every *multiTimeline.csv of a sample/country directory into its windows.parquet."""
+    files = sorted(f for f in os.listdir(directory) if storage.is_window(f, coarse=False) or storage.is_window(f, coarse=True))
+    if not files:
+        return 0
+
+    csv_windows = {file: storage.read_window_csv(os.path.join(directory, file)) for file in files}
+    # windows already in windows.parquet were downloaded there after the CSV, so they are kept
+    kept = set()
+    if storage.has_windows_file(directory):
+        kept = set(storage.window_files(directory, coarse=False) + storage.window_files(directory, coarse=True))
+    storage.add_windows(directory, {file: storage.window_frame(file, *window) for file, window in csv_windows.items()})
+
+    stored = dict(storage.read_windows(directory, coarse=False), **storage.read_windows(directory, coarse=True))
+    for file, (dates, _) in csv_windows.items():
+        if file not in stored or (file not in kept and len(stored[file][0]) != len(dates)):
+            raise ValueError(f"{directory}: {file} does not match its copy in {storage.WINDOWS_FILE}")
+        if remove_csv:
+            os.remove(os.path.join(directory, file))
+    return len(files)
+
+
+def migrate_series(path, remove_csv):
+    """Convert a <CC>_stitched.csv / <CC>_coarse_stitched.csv / annotated.csv to parquet next to it."""
+    df = storage.read_frame(path)
+    target = storage.series_path(path[:-len(".csv")], storage.PARQUET)
+    storage.replace_file(target, df.write_parquet)
+
+    if pl.read_parquet(target).height != df.height:
+        raise ValueError(f"{target}: row count differs from {path}")
+    if remove_csv:
+        os.remove(path)
+
+
+def is_series(file):
+    return file.endswith("_stitched.csv") or file == "annotated.csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert downloaded windows, stitched series and annotated series from CSV to parquet")
+    parser.add_argument("roots", nargs="+", help="directories to convert recursively (e.g. data, stitched_output, final_output)")
+    parser.add_argument("--remove-csv", action="store_true", help="delete the CSV files once their parquet copy is verified")
+
+    args = parser.parse_args()
+
+    windows = series = 0
+    for root in args.roots:
+        for directory, _, files in os.walk(root):
+            windows += migrate_windows(directory, args.remove_csv)
+            for file in sorted(files):
+                if is_series(file):
+                    migrate_series(os.path.join(directory, file), args.remove_csv)
+                    series += 1
+
+    print(f"✅ Converted {windows} windows and {series} series")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,49 +3,36 @@ import sys
 import argparse
 import warnings
 import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 
 import polars as pl
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from lib.detection import ChebyshevInequality, MedianMethod, IsolationForest, LocalOutlierFactor
+from lib.detection import ChebyshevInequality, MedianMethod, IsolationForest, LocalOutlierFactor, NormalityTest
+from lib import storage
 
-def main():
-    warnings.filterwarnings('ignore')
-
-    parser = argparse.ArgumentParser(description="Run anomaly detection on a single time series")
-    parser.add_argument("--path", required=True, help="path to time series")
-    parser.add_argument("--events", required=False, help="events to match against")
-    parser.add_argument("--algorithm", required=True, help="anomaly detection algorithm to use", choices=["chebyshev", "median", "iforest", "lof"])
-    parser.add_argument("--parameters", required=True, help="path to algorithm parameters")
-    parser.add_argument("--output", required=False, default=".", help="path to output directory")
-    
-    args = parser.parse_args()
+STITCHED_SUFFIX = "_stitched"
+ANNOTATED = "annotated"
+# detector state after the last run, kept next to the annotated series so the next day can resume from it
+CHECKPOINT = "detector_state.pkl"
 
-    try:
-        df = pl.read_csv(args.path, try_parse_dates=True)
-        with open(args.parameters, "rb") as file: parameters = list(pickle.load(file))
-    except FileNotFoundError as e:
-        print(e)
-        exit(1)
-
-    print(parameters)
+def build_detector(algorithm, parameters, normality=NormalityTest.SHAPIRO):
+    parameters = list(parameters)
     parameters[0] = round(parameters[0])
 
-    if args.algorithm == "chebyshev":
-        detector = ChebyshevInequality(*parameters)
-    elif args.algorithm == "median":
-        detector = MedianMethod(*parameters)
-    elif args.algorithm == "iforest":
-        detector = IsolationForest(*parameters)
-    elif args.algorithm == "lof":
-        detector = LocalOutlierFactor(*parameters)
-    
-    annotated = detector.run(df)
-    anomalies = detector.anomalies()
-    
-    print(anomalies)
-    print(anomalies["impact"].sum())
+    if algorithm == "chebyshev":
+        return ChebyshevInequality(*parameters, normality=normality)
+    elif algorithm == "median":
+        return MedianMethod(*parameters)
+    elif algorithm == "iforest":
+        return IsolationForest(*parameters)
+    elif algorithm == "lof":
+        return LocalOutlierFactor(*parameters)
 
+
+def add_quartiles(anomalies):
     # === add quartile column based on impact ===
     # 0 being the lowest impact and 3 being the highest
     anomalies = anomalies.sort("impact")
@@ -63,12 +50,179 @@ def main():
             quartiles = quartiles.cast(pl.Int64).to_list()
 
         anomalies = anomalies.with_columns(pl.Series("quartile", quartiles))
-    
-    os.makedirs(args.output, exist_ok=True)
 
-    annotated.write_csv(os.path.join(args.output, "annotated.csv"))
-    anomalies.sort("impact").write_csv(os.path.join(args.output, "anomalies.csv"))
-    
+    return anomalies
+
+
+def series_digest(df, rows):
+    return hashlib.sha256(df.head(rows).write_csv().encode()).hexdigest()
+
+
+def load_checkpoint(output, df, algorithm, parameters, normality):
+    """
+    Return the saved checkpoint in output if detection can resume from it: same detector, the days it
+    covered are unchanged in df and the annotated series is still there. Returns None otherwise.
+    """
+    checkpoint_path = os.path.join(output, CHECKPOINT)
+    if not os.path.isfile(checkpoint_path) or storage.find_series(os.path.join(output, ANNOTATED)) is None:
+        return None
+
+    with open(checkpoint_path, "rb") as file: checkpoint = pickle.load(file)
+
+    if (checkpoint["algorithm"], checkpoint["parameters"], checkpoint["normality"]) != (algorithm, parameters, normality):
+        return None
+    # history revised (e.g. restitched with a different scaling) or shortened
+    if checkpoint["rows"] > df.height or checkpoint["digest"] != series_digest(df, checkpoint["rows"]):
+        return None
+    return checkpoint
+
+
+def detect(path, parameters_path, algorithm, output, normality=NormalityTest.SHAPIRO, verbose=True, resume=False,
+           storage_format=storage.CSV):
+    """
+    Run detection on one stitched series (csv or parquet) and write the annotated series in
+    storage_format and anomalies.csv to output.
+
+    With resume, detection continues from the checkpoint of the previous run in output and only the
+    new days are processed and appended to annotated.csv (a parquet file is rewritten). Falls back to
+    a full run when there is no usable checkpoint or the normalization of the series changed.
+    """
+    warnings.filterwarnings('ignore')
+
+    df = storage.read_frame(path)
+    with open(parameters_path, "rb") as file: parameters = list(pickle.load(file))
+
+    if verbose: print(parameters)
+
+    annotated_stem = os.path.join(output, ANNOTATED)
+    annotated_path = storage.find_series(annotated_stem)
+    checkpoint = load_checkpoint(output, df, algorithm, parameters, normality) if resume else None
+
+    detector = build_detector(algorithm, parameters, normality)
+    resumed_rows = None
+    if checkpoint is not None:
+        detector.load_state(checkpoint["state"])
+        previous = storage.read_frame(annotated_path).with_columns(pl.col("index").cast(pl.UInt32))
+        try:
+            annotated = detector.resume(df, previous)
+            resumed_rows = checkpoint["rows"]
+        except (ValueError, pl.exceptions.PolarsError) as e:
+            # printed in batch mode too: a rerun of every day is worth knowing about
+            print(f"Cannot resume {output}, rerunning: {e}")
+            detector = build_detector(algorithm, parameters, normality)
+
+    if resumed_rows is None:
+        annotated = detector.run(df)
+    anomalies = detector.anomalies()
+
+    if verbose:
+        print(anomalies)
+        print(anomalies["impact"].sum())
+
+    anomalies = add_quartiles(anomalies)
+
+    os.makedirs(output, exist_ok=True)
+
+    # only a CSV in the requested format can be appended to, anything else is rewritten
+    if resumed_rows is None or storage_format != storage.CSV or annotated_path != storage.series_path(annotated_stem, storage.CSV):
+        storage.write_frame(annotated, annotated_stem, storage_format)
+    else:
+        with open(annotated_path, "a") as file: annotated.slice(resumed_rows).write_csv(file, include_header=False)
+    # anomalies and their quartiles depend on the whole series, so they are always rewritten
+    anomalies.sort("impact").write_csv(os.path.join(output, "anomalies.csv"))
+
+    with open(os.path.join(output, CHECKPOINT), "wb") as file:
+        pickle.dump({"algorithm": algorithm, "parameters": parameters, "normality": normality,
+                     "rows": df.height, "digest": series_digest(df, df.height), "state": detector.state()}, file)
+
+
+def discover_series(stitched_root, param_root):
+    """Map country code -> (stitched series, parameters) for every <CC>_stitched.csv/.parquet with a parameter file."""
+    series = {}
+    for file in sorted(os.listdir(stitched_root)):
+        stem, extension = os.path.splitext(file)
+        if extension[1:] not in storage.FORMATS or not stem.endswith(STITCHED_SUFFIX) or stem.endswith("_coarse" + STITCHED_SUFFIX):
+            continue
+        code = stem[:-len(STITCHED_SUFFIX)]
+        # a series kept in both formats is detected once, from the one storage.find_series prefers
+        if storage.find_series(os.path.join(stitched_root, stem)) != os.path.join(stitched_root, file):
+            continue
+        parameters_path = os.path.join(param_root, code)
+        if not os.path.isfile(parameters_path):
+            print(f"  ⚠️  No parameters for {code}, skipping.")
+            continue
+        series[code] = (os.path.join(stitched_root, file), parameters_path)
+    return series
+
+
+def detect_country(code, path, parameters_path, algorithm, output_root, normality, resume=False, storage_format=storage.CSV):
+    detect(path, parameters_path, algorithm, os.path.join(output_root, code), normality, verbose=False, resume=resume,
+           storage_format=storage_format)
+    return code
+
+
+def run_batch(stitched_root, param_root, algorithm, output_root, normality, workers=None, resume=False, storage_format=storage.CSV):
+    """Run detection for every country of a topic across a process pool, one task per country; returns the failed codes."""
+    series = discover_series(stitched_root, param_root)
+    worker = partial(detect_country, algorithm=algorithm, output_root=output_root, normality=normality, resume=resume,
+                     storage_format=storage_format)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(worker, code, path, parameters_path): code for code, (path, parameters_path) in series.items()}
+
+        for fut in as_completed(futures):
+            code = futures[fut]
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"❌ {code} failed: {e}")
+                failed.append(code)
+            else:
+                print(f"✅ {code} done")
+    return sorted(failed)
+
+
+def main():
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description="Run anomaly detection on a single time series, or on every stitched series of a topic")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--path", help="path to time series")
+    target.add_argument("--stitched-root", help="batch mode: directory of <CC>_stitched.csv/.parquet files for one topic")
+    parser.add_argument("--events", required=False, help="events to match against")
+    parser.add_argument("--algorithm", required=True, help="anomaly detection algorithm to use", choices=["chebyshev", "median", "iforest", "lof"])
+    parser.add_argument("--parameters", required=False, help="path to algorithm parameters")
+    parser.add_argument("--param-root", required=False, help="batch mode: directory of per-country parameter files named <CC>")
+    parser.add_argument("--output", required=False, default=".", help="path to output directory (batch mode: one <CC> subdirectory per country)")
+    parser.add_argument("--workers", type=int, default=None, help="batch mode: processes (default = cpu count)")
+    parser.add_argument("--normality", required=False, default=NormalityTest.SHAPIRO, choices=list(NormalityTest),
+                        help="normality test used by chebyshev to choose between z and k")
+    parser.add_argument("--resume", action="store_true",
+                        help="only process days added since the last run in the output directory, appending to annotated.csv")
+    parser.add_argument("--storage", choices=storage.FORMATS, default=storage.CSV, help="format of the annotated series")
+
+    args = parser.parse_args()
+
+    if args.stitched_root is not None:
+        if args.param_root is None:
+            parser.error("--stitched-root requires --param-root")
+        failed = run_batch(args.stitched_root, args.param_root, args.algorithm, args.output, args.normality, args.workers,
+                           args.resume, args.storage)
+        if failed:
+            print(f"{len(failed)} countries failed: {' '.join(failed)}")
+            sys.exit(1)
+        return
+
+    if args.parameters is None:
+        parser.error("--path requires --parameters")
+
+    try:
+        detect(args.path, args.parameters, args.algorithm, args.output, args.normality, resume=args.resume, storage_format=args.storage)
+    except FileNotFoundError as e:
+        print(e)
+        exit(1)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
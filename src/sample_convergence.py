@@ -0,0 +1,110 @@
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from lib import storage
+from lib.download_journal import DONE, FAILED, JOURNAL_FILE, PENDING, DownloadJournal
+from lib.stitching import SampleWindows
+
+SAMPLE_COUNTS = "sample_counts.csv"
+QUANTILE = 0.95
+
+
+def journaled_complete(sample_dir, country_code):
+    """Whether the journal of a sample has every window of the country done; None if the sample has no journal."""
+    if not os.path.isfile(os.path.join(sample_dir, JOURNAL_FILE)):
+        return None
+    journal = DownloadJournal(sample_dir)
+    try:
+        counts = journal.counts(country_code)
+    finally:
+        journal.close()
+    return counts[DONE] > 0 and counts[PENDING] == counts[FAILED] == 0
+
+
+def window_count(country_dir):
+    return len(storage.window_files(country_dir, coarse=False)), len(storage.window_files(country_dir, coarse=True))
+
+
+def country_sample_dirs(output_dir, country_code, num_samples):
+    """
+    sample0/<CC> .. sample<n-1>/<CC> that were downloaded completely; a converged country has none after
+    its last sample. A sample with a journal counts once all of the country's windows are journaled
+    done; one without (downloaded before journaling) once it has as many windows and coarse windows
+    as the country's fullest sample.
+    """
+    dirs = [os.path.join(output_dir, f"sample{i}", country_code) for i in range(num_samples)]
+    dirs = [d for d in dirs if os.path.isdir(d)]
+    journaled = {d: journaled_complete(os.path.dirname(d), country_code) for d in dirs}
+    counts = {d: window_count(d) for d in dirs if journaled[d] is None}
+    full = tuple(max(count) for count in zip(*counts.values())) if counts else None
+    return [d for d in dirs if journaled[d] or (journaled[d] is None and counts[d] == full and full[0] > 0)]
+
+
+def country_standard_error(sample_dirs, quantile=QUANTILE):
+    """
+    The quantile of the standard errors of the per-date sample means over the country's windows and
+    coarse windows; a few dates where one sample dropped to zero would otherwise keep every country going.
+    """
+    errors = [SampleWindows.load(sample_dirs, coarse).standard_error() for coarse in (False, True)]
+    errors = np.concatenate([error[~np.isnan(error)] for error in errors])
+    return np.quantile(errors, quantile) if errors.size else np.inf
+
+
+def read_sample_counts(output_dir):
+    path = os.path.join(output_dir, SAMPLE_COUNTS)
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=["country_code", "samples", "standard_error", "converged"])
+    return pd.read_csv(path, keep_default_na=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the countries whose sample means have not converged yet and record the samples each used")
+    parser.add_argument("output_dir", help="daily output directory with sample0, sample1, ...")
+    parser.add_argument("--country_code", default="country_codes.csv", help="CSV of the countries being downloaded")
+    parser.add_argument("--samples", type=int, required=True, help="samples downloaded so far (sample0 .. sample<n-1>)")
+    parser.add_argument("--min_samples", type=int, default=10, help="samples every country gets before it may stop")
+    parser.add_argument("--tolerance", type=float, required=True,
+                        help="a country stops once the --quantile of the standard errors of its per-date means is at most this (Google Trends points)")
+    parser.add_argument("--quantile", type=float, default=QUANTILE, help="quantile of the per-date standard errors compared to the tolerance (1 = all dates)")
+    parser.add_argument("--pending", required=True, help="where to write the country CSV of the countries that need more samples")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default = cpu count)")
+
+    args = parser.parse_args()
+
+    countries = pd.read_csv(args.country_code)
+    counts = read_sample_counts(args.output_dir).set_index("country_code")
+    # countries that converged before keep their count and get no more samples
+    converged = set(counts.index[counts["converged"].astype(str) == "True"])
+    checked = [c for c in countries["country_code"].unique() if c not in converged]
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(country_standard_error, country_sample_dirs(args.output_dir, c, args.samples), args.quantile): c
+                   for c in checked}
+        for future in as_completed(futures):
+            country_code = futures[future]
+            samples = len(country_sample_dirs(args.output_dir, country_code, args.samples))
+            try:
+                error = future.result()
+            except Exception as e:
+                print(f"❌ {country_code}: {e}")
+                error = np.inf
+            done = samples >= args.min_samples and error <= args.tolerance
+            counts.loc[country_code, ["samples", "standard_error", "converged"]] = [samples, error, done]
+            if done:
+                converged.add(country_code)
+                print(f"✅ {country_code} converged after {samples} samples (standard error {error:.3f})")
+
+    counts.reset_index().to_csv(os.path.join(args.output_dir, SAMPLE_COUNTS), index=False)
+    pending = countries[~countries["country_code"].isin(converged)]
+    pending.to_csv(args.pending, index=False)
+    print(f"{pending['country_code'].nunique()} countries need more samples")
+
+
+if __name__ == "__main__":
+    main()
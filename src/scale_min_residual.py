@@ -1,8 +1,12 @@
 import os
+import sys
 import pickle
 import polars as pl
 import argparse
 
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from lib import storage
+
 # Set up argument parser
 parser = argparse.ArgumentParser(description="Scale pickled residuals using stitched CSV values.")
 parser.add_argument("term", help="Term we are running on.")
@@ -21,9 +25,9 @@ os.makedirs(output_pickle_dir, exist_ok=True)
 
 for country_code in os.listdir(input_pickle_dir):
     pickle_path = os.path.join(input_pickle_dir, country_code)
-    csv_path = os.path.join(stitched_csv_dir, f"{country_code}_stitched.csv")
+    csv_path = storage.find_series(os.path.join(stitched_csv_dir, f"{country_code}_stitched"))
 
-    if not os.path.isfile(csv_path):
+    if csv_path is None:
         print(f"[WARNING] No stitched output for {country_code}, skipping.")
         continue
 
@@ -37,7 +41,7 @@ for country_code in os.listdir(input_pickle_dir):
     window, z, k, min_residual, efficiency = data
 
     try:
-        df = pl.read_csv(csv_path, schema_overrides={"value": pl.Float64})
+        df = storage.read_frame(csv_path).with_columns(pl.col("value").cast(pl.Float64))
         max_val = df["value"].max()
         scaling_factor = max_val / 100 if max_val > 100 else 1
     except Exception as e:
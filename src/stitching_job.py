@@ -2,34 +2,100 @@
 
 import argparse
 import os
+import pickle
 from typing import List
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from multiprocessing import resource_tracker
 from functools import partial
 from tqdm import tqdm
-from lib.stitching import combine_stitched_dfs_intersection, stitch_two_windows_ratio_coarse
-
-def sorted_files(dir_path: str, coarse: bool) -> List[str]:
-    flist = [
-        f
-        for f in os.listdir(dir_path)
-        if (
-            f.endswith("coarseMultiTimeline.csv") if coarse
-            else (f.endswith("multiTimeline.csv") and "coarse" not in f)
-        )
-    ]
-    return sorted(flist)
-
-
-def combine_window(sample_dirs: List[str], win_idx: int, coarse: bool) -> pd.DataFrame:
-    dfs = []
-    for d in sample_dirs:
-        files = sorted_files(d, coarse)
-        if win_idx >= len(files):
-            raise IndexError(f"{d} has only {len(files)} windows; need idx {win_idx}, coarse is set to {coarse}")
-        df = pd.read_csv(os.path.join(d, files[win_idx]), parse_dates=["date"])
-        dfs.append(df)
-    return combine_stitched_dfs_intersection(dfs, use_mean=True, nonzero_fraction=1)
+from lib.stitching import ENGINES, NUMPY, POLARS, SampleWindows, StitchedSeries, load_windows, to_days, from_days
+from lib import storage
+
+# sidecar of <CC>_stitched: the tail of the series the next day's windows can overlap, the coarse
+# series of the last window and the last scale, so an incremental run never reads the full series
+STATE_SUFFIX = "_stitch_state.pkl"
+# daily windows start at most 10 months back, their coarse series as well
+TAIL_DAYS = 400
+# (size, mtime) of the inputs and outputs of every country at its last stitch, to skip unchanged ones
+MANIFEST = "stitch_manifest.pkl"
+
+
+def load_state(out_root, code, stitched_path, storage_format):
+    """The sidecar of the stitched series in out_root if it was written with it, else None."""
+    state_path = os.path.join(out_root, f"{code}{STATE_SUFFIX}")
+    if stitched_path is None or not os.path.isfile(state_path):
+        return None
+    # appending needs the stitched series to be the output, in the output format
+    if stitched_path != storage.series_path(os.path.join(out_root, f"{code}_stitched"), storage_format):
+        return None
+
+    with open(state_path, "rb") as file: state = pickle.load(file)
+
+    stat = os.stat(stitched_path)
+    if (state["size"], state["mtime"]) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return state
+
+
+def save_state(out_root, code, stitched_path, stitched: StitchedSeries, coarse_days, coarse, scale):
+    tail = stitched.tail(TAIL_DAYS)
+    stat = os.stat(stitched_path)
+    with open(os.path.join(out_root, f"{code}{STATE_SUFFIX}"), "wb") as file:
+        pickle.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns, "prefix": tail.prefix,
+                     "days": tail.days, "values": tail.values.astype(tail.dtype),
+                     "coarse_days": coarse_days, "coarse": coarse, "scale": scale}, file)
+
+
+def file_signature(path):
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def country_signature(code, sample_dirs, stitched_root, out_root, storage_format):
+    """
+    Signature of everything a country's stitch reads and writes: the window files of its samples,
+    the stitched series it continues and the outputs. Equal signatures mean nothing changed since.
+    """
+    paths = [path for d in sample_dirs if os.path.isdir(d) for path in storage.window_sources(d)]
+    for root, stem in ((stitched_root, f"{code}_stitched"), (stitched_root, f"{code}_coarse_stitched")):
+        paths.append(storage.find_series(os.path.join(root, stem)) or os.path.join(root, stem))
+    for stem in (f"{code}_stitched", f"{code}_coarse_stitched"):
+        paths.append(storage.series_path(os.path.join(out_root, stem), storage_format))
+    return storage_format, [(path, file_signature(path)) for path in paths]
+
+
+def load_manifest(out_root):
+    path = os.path.join(out_root, MANIFEST)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "rb") as file: return pickle.load(file)
+
+
+def save_manifest(out_root, manifest):
+    def write(path):
+        with open(path, "wb") as file: pickle.dump(manifest, file)
+
+    os.makedirs(out_root, exist_ok=True)
+    storage.replace_file(os.path.join(out_root, MANIFEST), write)
+
+
+def stitch_windows(stitched: StitchedSeries, windows, coarse_windows, coarse_days, coarse):
+    """Stitch every window onto stitched; returns the coarse series of the last window and the last scale."""
+    scale = None
+    for win_idx in range(len(windows)):
+        
+        days, values = windows.combine(win_idx)
+        new_coarse_days, new_coarse = coarse_windows.combine(win_idx)
+
+        window_scale = stitched.stitch_ratio_coarse(days, values, coarse_days, coarse, new_coarse_days, new_coarse)
+        scale = scale if window_scale is None else window_scale
+
+        coarse_days, coarse = new_coarse_days, new_coarse
+
+    return coarse_days, coarse, scale
 
 
 def process_country(
@@ -37,83 +103,235 @@ def process_country(
     sample_dirs: List[str],
     stitched_root: str,
     out_root: str,
+    storage_format: str = storage.CSV,
+    incremental: bool = False,
+    stream: bool = False,
+    engine: str = NUMPY,
+    shared: dict = None,
 ) -> str:
-    """Combine & stitch one country; return the code on success."""
-    stitched_path = os.path.join(stitched_root, f"{code}_stitched.csv")
-    stitched_coarse_path = os.path.join(stitched_root, f"{code}_coarse_stitched.csv")
+    """
+    Combine & stitch one country; return the code on success.
 
-    if not (os.path.isfile(stitched_path) and os.path.isfile(stitched_coarse_path)):
+    With incremental, the new days are stitched onto the tail kept in the sidecar of the previous
+    run and appended to the stitched series. Falls back to restitching from the full series when
+    there is no sidecar for it or the windows reach back before the tail. With stream, samples are
+    folded into each window's mean as they are read instead of being loaded up front. engine
+    polars reads and combines the samples with one multi-threaded query per country. shared holds
+    the descriptors of windows a loader already put in shared memory (see load_shared).
+    """
+    stitched_path = storage.find_series(os.path.join(stitched_root, f"{code}_stitched"))
+    stitched_coarse_path = storage.find_series(os.path.join(stitched_root, f"{code}_coarse_stitched"))
+
+    if stitched_path is None or stitched_coarse_path is None:
         raise FileNotFoundError(f"Stitched files missing for {code}")
 
-    stitched_prev = pd.read_csv(stitched_path, parse_dates=["date"])
-    stitched_prev_coarse = pd.read_csv(stitched_coarse_path, parse_dates=["date"])
+    if shared is not None:
+        windows, coarse_windows = SampleWindows.attach(shared["windows"]), SampleWindows.attach(shared["coarse"])
+        try:
+            return stitch_country(code, windows, coarse_windows, stitched_path, stitched_coarse_path, out_root,
+                                  storage_format, incremental)
+        finally:
+            windows.detach()
+            coarse_windows.detach()
 
-    n_windows = len(sorted_files(sample_dirs[0], coarse=False))
+    # every sample window is read once, up front unless streamed
+    windows = load_windows(sample_dirs, coarse=False, stream=stream, engine=engine)
+    coarse_windows = load_windows(sample_dirs, coarse=True, stream=stream, engine=engine)
+    return stitch_country(code, windows, coarse_windows, stitched_path, stitched_coarse_path, out_root,
+                          storage_format, incremental)
 
-    for win_idx in range(n_windows):
-        
-        new_win = combine_window(sample_dirs, win_idx, coarse=False)
-        new_win_coarse = combine_window(sample_dirs, win_idx, coarse=True)
 
-        overlap = set(stitched_prev["date"]) & set(new_win["date"])
-        stitched_prev = stitch_two_windows_ratio_coarse(
-            stitched_prev,
-            new_win,
-            stitched_prev_coarse,
-            new_win_coarse,
-            overlap,
-            write=False,
-        )
+def stitch_country(code, windows, coarse_windows, stitched_path, stitched_coarse_path, out_root,
+                   storage_format=storage.CSV, incremental=False) -> str:
+    """Stitch a country's loaded windows onto its previous series and write the results."""
+    out_stem = os.path.join(out_root, f"{code}_stitched")
 
-        stitched_prev_coarse =  new_win_coarse
+    state = load_state(out_root, code, stitched_path, storage_format) if incremental else None
+    if state is not None:
+        stitched = StitchedSeries(state["days"], state["values"], prefix=state["prefix"])
+        rows = len(stitched)
+        try:
+            coarse_days, coarse, scale = stitch_windows(stitched, windows, coarse_windows, state["coarse_days"], state["coarse"])
+        except ValueError:
+            state = None
+        else:
+            # a series that turns from integer to float has to be rewritten as a whole
+            if stitched.dtype != state["values"].dtype:
+                state = None
+
+    if state is None:
+        stitched_prev = storage.read_series(stitched_path)
+        stitched_prev_coarse = storage.read_series(stitched_coarse_path)
+        stitched = StitchedSeries.from_frame(stitched_prev)
+        coarse_days, coarse, scale = stitch_windows(stitched, windows, coarse_windows,
+                                                    to_days(stitched_prev_coarse["date"]), stitched_prev_coarse["value"].to_numpy())
 
     # write results
     os.makedirs(out_root, exist_ok=True)
-    out_normal = os.path.join(out_root, f"{code}_stitched.csv")
-    out_coarse = os.path.join(out_root, f"{code}_coarse_stitched.csv")
-    stitched_prev.to_csv(out_normal, index=False)
-    stitched_prev_coarse.to_csv(out_coarse, index=False)
+    if state is None:
+        stitched_path = storage.write_series(stitched.to_frame(), out_stem, storage_format)
+    else:
+        storage.append_series(stitched.to_frame(rows), stitched_path)
+        scale = scale if scale is not None else state["scale"]
+    if len(windows):
+        # the coarse series of the last window
+        storage.write_series(pd.DataFrame({"date": from_days(coarse_days), "value": coarse}),
+                             os.path.join(out_root, f"{code}_coarse_stitched"), storage_format)
+    elif state is None:
+        storage.write_series(stitched_prev_coarse, os.path.join(out_root, f"{code}_coarse_stitched"), storage_format)
+    save_state(out_root, code, stitched_path, stitched, coarse_days, coarse, scale)
 
     return code
 
 
+def load_shared(sample_dirs: List[str]) -> dict:
+    """Loader: read a country's windows into shared memory, for process_country(shared=...)."""
+    windows = SampleWindows.load(sample_dirs, coarse=False)
+    coarse_windows = SampleWindows.load(sample_dirs, coarse=True)
+    shared = {"windows": windows.share()}
+    try:
+        shared["coarse"] = coarse_windows.share()
+    except BaseException:
+        release_shared(shared)
+        raise
+    return shared
+
+
+def release_shared(shared: dict):
+    for descriptor in shared.values():
+        SampleWindows.unlink(descriptor)
+
+
+def run_shared(country_samples, worker, workers, loaders, report):
+    """
+    Loader processes read countries into shared memory while the worker pool stitches those already
+    loaded from zero-copy views, so parsing overlaps stitching. At most two countries per worker are
+    held in shared memory at a time; each is freed once stitched.
+    """
+    # one resource tracker for the whole tree, so blocks outlive the loader that created them
+    resource_tracker.ensure_running()
+    pending = iter(country_samples.items())
+    limit = 2 * (workers or os.cpu_count())
+    loading, stitching = {}, {}
+
+    def load_next():
+        for code, dirs in pending:
+            loading[loaders_pool.submit(load_shared, dirs)] = code
+            return
+
+    with ProcessPoolExecutor(max_workers=loaders) as loaders_pool, ProcessPoolExecutor(max_workers=workers) as pool:
+        for _ in range(limit):
+            load_next()
+
+        try:
+            while loading or stitching:
+                done, _ = wait(set(loading) | set(stitching), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    if fut in loading:
+                        code = loading.pop(fut)
+                        if fut.exception() is not None:
+                            report(code, fut)
+                            load_next()
+                            continue
+                        stitching[pool.submit(worker, code, country_samples[code], shared=fut.result())] = (code, fut.result())
+                    else:
+                        code, shared = stitching.pop(fut)
+                        release_shared(shared)
+                        report(code, fut)
+                        load_next()
+        finally:
+            # countries loaded but never stitched, e.g. on KeyboardInterrupt
+            for fut in loading:
+                if not fut.cancel() and fut.exception() is None:
+                    release_shared(fut.result())
+            for _, shared in stitching.values():
+                release_shared(shared)
+
+
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--samples-root", required=True)
     ap.add_argument("--stitched-root", required=True)
     ap.add_argument("--out-root", required=True)
     ap.add_argument("--workers", type=int, default=None,
-                    help="Processes (default = cpu count)")
+                    help="Processes (default = cpu count, 1 with the polars engine)")
+    ap.add_argument("--engine", choices=ENGINES, default=NUMPY,
+                    help="Read and combine samples with numpy, or with polars using every core per country")
+    ap.add_argument("--storage", choices=storage.FORMATS, default=storage.CSV,
+                    help="Format of the stitched output (either format is read)")
+    ap.add_argument("--incremental", action="store_true",
+                    help="Append the new days to the stitched output using the sidecar of the last run")
+    ap.add_argument("--num-samples", type=int, default=45,
+                    help="Samples per country (sample0 .. sample<n-1>)")
+    ap.add_argument("--stream-samples", action="store_true",
+                    help="Fold samples into running per-date sums instead of loading them all, bounding memory")
+    ap.add_argument("--shared-memory", action="store_true",
+                    help="Read samples in loader processes into shared memory that the workers stitch from")
+    ap.add_argument("--loaders", type=int, default=1,
+                    help="Loader processes with --shared-memory")
+    ap.add_argument("--force", action="store_true",
+                    help="Restitch every country, even those whose inputs are unchanged since the last run")
     args = ap.parse_args()
+    if args.shared_memory and (args.stream_samples or args.engine != NUMPY):
+        ap.error("--shared-memory loads the samples with the numpy engine, without streaming")
 
     # gather sample folders
     sample0_dir = os.path.join(args.samples_root, "sample0")
     country_codes = sorted(
         d for d in os.listdir(sample0_dir) if os.path.isdir(os.path.join(sample0_dir, d))
     )
+    # a country that converged early (update_samples.sh with SAMPLE_TOLERANCE) has fewer samples
     country_samples = {
-        code: [os.path.join(args.samples_root, f"sample{i}", code) for i in range(45)]
+        code: [d for d in (os.path.join(args.samples_root, f"sample{i}", code) for i in range(args.num_samples))
+               if os.path.isdir(d)]
         for code in country_codes
     }
 
+    signature = partial(country_signature, stitched_root=args.stitched_root, out_root=args.out_root,
+                        storage_format=args.storage)
+    manifest = {} if args.force else load_manifest(args.out_root)
+    unchanged = [c for c, dirs in country_samples.items() if c in manifest and manifest[c] == signature(c, dirs)]
+    for code in unchanged:
+        print(f"⏭️  {code} unchanged, skipped")
+        del country_samples[code]
+
     worker = partial(
         process_country,
         stitched_root=args.stitched_root,
         out_root=args.out_root,
+        storage_format=args.storage,
+        incremental=args.incremental,
+        stream=args.stream_samples,
+        engine=args.engine,
     )
+    # polars already spreads a country over every core
+    workers = args.workers or (1 if args.engine == POLARS else None)
+
+    progress = tqdm(total=len(country_samples), desc="Countries")
+
+    def report(code, fut):
+        progress.update()
+        try:
+            fut.result()
+        except Exception as e:
+            print(f"❌ {code} failed: {e}")
+            manifest.pop(code, None)
+        else:
+            print(f"✅ {code} done")
+            manifest[code] = signature(code, country_samples[code])
+
+    if args.shared_memory:
+        run_shared(country_samples, worker, workers, args.loaders, report)
+    else:
+        # launch all countries in parallel
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(worker, c, dirs): c for c, dirs in country_samples.items()}
+
+            for fut in as_completed(futures):
+                report(futures[fut], fut)
 
-    # launch all countries in parallel
-    with ProcessPoolExecutor(max_workers=args.workers) as pool:
-        futures = {pool.submit(worker, c, dirs): c for c, dirs in country_samples.items()}
-
-        for fut in tqdm(as_completed(futures), total=len(futures), desc="Countries"):
-            code = futures[fut]
-            try:
-                fut.result()
-            except Exception as e:
-                print(f"❌ {code} failed: {e}")
-            else:
-                print(f"✅ {code} done")
+    progress.close()
+    save_manifest(args.out_root, manifest)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,223 @@
+"""
+Local stand-in for the Google Trends API, for running the downloader without an API key or quota.
+
+It serves the discovery document that googleapiclient builds the trends v1beta service from, and a
+getGraph method returning synthetic lines[0].points: a fixed random walk per geo with fresh noise
+per request (so samples differ like real ones), normalized to 100 over the requested range, daily up
+to 270 days, weekly up to five years and monthly beyond. It can add latency and answer with 429s, at
+random or once a quota of requests per second is used up. Point the downloader at it with
+
+    DISCOVERY_URL='http://127.0.0.1:8765/$discovery/rest?version=v1beta' python3 src/get_gt_data.py ...
+
+(any api_key.txt will do).
+"""
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+API_VERSION = "v1beta"
+GRAPH_PATH = f"{API_VERSION}/graph"
+ORIGIN = datetime.date(2004, 1, 1)
+
+
+def discovery_document(root_url):
+    query = {"type": "string", "location": "query"}
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": f"trends:{API_VERSION}",
+        "name": "trends",
+        "version": API_VERSION,
+        "protocol": "rest",
+        "rootUrl": root_url,
+        "servicePath": "",
+        "baseUrl": root_url,
+        "batchPath": "batch",
+        "parameters": {"key": query, "alt": dict(query, default="json")},
+        # a method without a response schema returns raw bytes instead of parsed JSON
+        "schemas": {
+            "Point": {"id": "Point", "type": "object",
+                      "properties": {"date": {"type": "string"}, "value": {"type": "integer"}}},
+            "Line": {"id": "Line", "type": "object",
+                     "properties": {"term": {"type": "string"}, "points": {"type": "array", "items": {"$ref": "Point"}}}},
+            "Graph": {"id": "Graph", "type": "object",
+                      "properties": {"lines": {"type": "array", "items": {"$ref": "Line"}}}},
+        },
+        "methods": {
+            "getGraph": {
+                "id": "trends.getGraph",
+                "path": GRAPH_PATH,
+                "flatPath": GRAPH_PATH,
+                "httpMethod": "GET",
+                "parameters": {
+                    "terms": dict(query, repeated=True),
+                    "restrictions.startDate": query,
+                    "restrictions.endDate": query,
+                    "restrictions.geo": query,
+                },
+                "response": {"$ref": "Graph"},
+            },
+        },
+        "resources": {},
+    }
+
+
+def _month_start(month):
+    return datetime.datetime.strptime(month, "%Y-%m").date()
+
+
+def graph_points(geo, start_month, end_month, rng):
+    """Synthetic points of a geo from the first day of start_month to the last of end_month (at most yesterday)."""
+    start = _month_start(start_month)
+    end = min((pd.Timestamp(_month_start(end_month)) + pd.offsets.MonthEnd(0)).date(),
+              datetime.date.today() - datetime.timedelta(days=1))
+    if end < start:
+        return []
+
+    # the same walk for a geo in every request, days since ORIGIN
+    walk_rng = np.random.default_rng(zlib.crc32(geo.encode()))
+    walk = np.abs(50 + np.cumsum(walk_rng.normal(0, 1, (end - ORIGIN).days + 1))) + 1
+
+    span = (end - start).days
+    freq = "D" if span <= 270 else "W-SUN" if span <= 5 * 366 else "MS"
+    dates = pd.date_range(start, end, freq=freq)
+    values = walk[(dates - pd.Timestamp(ORIGIN)).days] * rng.uniform(0.9, 1.1, dates.size)
+    values = np.round(100 * values / values.max()).astype(int)
+    return [{"date": date.strftime("%Y-%m-%d"), "value": int(value)} for date, value in zip(dates, values)]
+
+
+class StandIn:
+    """Behaviour and request counts of a stand-in server; the counters are updated by the handler threads."""
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=None, burst=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.stats = {"discovery": 0, "requests": 0, "ok": 0, "rate_limited": 0}
+
+    def admit(self):
+        """Whether a getGraph request is within quota (and not picked for a random 429)."""
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.rng.random() < self.error_rate:
+                self.stats["rate_limited"] += 1
+                return False
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_limit)
+                self.updated = now
+                if self.tokens < 1:
+                    self.stats["rate_limited"] += 1
+                    return False
+                self.tokens -= 1
+            self.stats["ok"] += 1
+            return True
+
+    def delay(self):
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+        time.sleep(delay)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        standin = self.server.standin
+        if url.path == "/$discovery/rest":
+            with standin.lock:
+                standin.stats["discovery"] += 1
+            host, port = self.server.server_address[:2]
+            return self.reply(200, discovery_document(f"http://{host}:{port}/"))
+        if url.path == f"/{GRAPH_PATH}":
+            return self.get_graph(parse_qs(url.query))
+        if url.path == "/stats":
+            return self.reply(200, standin.snapshot())
+        self.reply(404, {"error": {"code": 404, "message": f"{url.path} not found", "status": "NOT_FOUND"}})
+
+    def get_graph(self, query):
+        standin = self.server.standin
+        standin.delay()
+        if not standin.admit():
+            return self.reply(429, {"error": {"code": 429, "message": "Quota exceeded for quota metric 'Queries'",
+                                              "status": "RESOURCE_EXHAUSTED"}})
+        try:
+            geo = query["restrictions.geo"][0]
+            start, end = query["restrictions.startDate"][0], query["restrictions.endDate"][0]
+            terms = query.get("terms", [""])
+        except KeyError as e:
+            return self.reply(400, {"error": {"code": 400, "message": f"missing {e}", "status": "INVALID_ARGUMENT"}})
+        with standin.lock:
+            seed = standin.rng.getrandbits(64)
+        points = graph_points(geo, start, end, np.random.default_rng(seed))
+        self.reply(200, {"lines": [{"term": terms[0], "points": points}]})
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # one line per request would drown the downloader's own output
+        pass
+
+
+def serve(standin: StandIn, host="127.0.0.1", port=0) -> ThreadingHTTPServer:
+    """Start a stand-in server on a daemon thread (port 0 picks a free one); stop it with shutdown()."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.standin = standin
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def discovery_url(server: ThreadingHTTPServer):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/$discovery/rest?version={API_VERSION}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Google Trends getGraph API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every getGraph request takes at least")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds more, at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429 at random")
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests per second within quota; beyond it 429s")
+    parser.add_argument("--burst", type=int, default=1, help="requests within quota at once after an idle period")
+    parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    server = serve(StandIn(args.latency, args.jitter, args.error_rate, args.rate_limit, args.burst, args.seed),
+                   args.host, args.port)
+    print(f"Serving the Trends stand-in; DISCOVERY_URL='{discovery_url(server)}'")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print(server.standin.snapshot())
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ START_MONTH_OVERRIDE=""
 CURRENT_MONTH=$(date +"%Y-%m")
 DAILY_UPDATE=""  # Default to true
 
+# Set when a convergence check fails, so the run exits non-zero once every topic is sampled
+CONVERGENCE_FAILED=""
+
 # Define topics (or load dynamically)
 TOPICS=("vpn")
 
@@ -54,22 +57,41 @@ run_download() {
   local sample_dir="$2"
   local start_month="$3"
   local end_month="$4"
+  local country_codes_file="$5"
 
   echo "🟢 Downloading topic '$topic' → $sample_dir"
   echo "   Start: $start_month → End: $end_month"
   echo "   Daily update: $DAILY_UPDATE"
 
   python3 "$GET_GT_SCRIPT" \
-    --country_code "$COUNTRY_CODES_FILE" \
+    --country_code "$country_codes_file" \
     --data_output_existing "$sample_dir" \
     --log_level "INFO" \
     --sliding_window_size 8 \
     --sliding_window_overlap 7 \
     --start_month "$start_month" \
     --topic "$topic" \
+    --storage "$STORAGE" \
+    --fetcher "$FETCHER" \
+    --resume \
     $DAILY_UPDATE
 }
 
+check_convergence() {
+  local output_dir="$1"
+  local samples="$2"
+  local pending_file="$3"
+
+  # never leave an earlier check's list to be mistaken for this one's
+  rm -f "$pending_file"
+  python3 src/sample_convergence.py "$output_dir" \
+    --country_code "$COUNTRY_CODES_FILE" \
+    --samples "$samples" \
+    --min_samples "$MIN_SAMPLES" \
+    --tolerance "$SAMPLE_TOLERANCE" \
+    --pending "$pending_file"
+}
+
 main() {
   parse_args "$@"
   check_required_files
@@ -82,12 +104,39 @@ main() {
     mkdir -p "$OUTPUT_DIR"
 
     echo "📂 Processing topic: $topic"
-    for i in $(seq 0 44); do
+    for i in $(seq 0 $((MAX_SAMPLES - 1))); do
+      codes_file="$COUNTRY_CODES_FILE"
+      if [[ -n "$SAMPLE_TOLERANCE" && $i -ge $MIN_SAMPLES ]]; then
+        # only countries whose per-date means have not converged get another sample
+        codes_file="$OUTPUT_DIR/pending_countries.csv"
+        if ! check_convergence "$OUTPUT_DIR" "$i" "$codes_file" || [[ ! -f "$codes_file" ]]; then
+          # a failed check says nothing about convergence: sample every country again
+          echo "[ERROR] Convergence check failed after $i samples, sampling every country"
+          CONVERGENCE_FAILED=1
+          codes_file="$COUNTRY_CODES_FILE"
+        elif [[ $(wc -l < "$codes_file") -le 1 ]]; then
+          echo "✅ Every country converged after $i samples"
+          break
+        fi
+      fi
+
       SAMPLE_DIR="$OUTPUT_DIR/sample$i"
       mkdir -p "$SAMPLE_DIR"
-      run_download "$topic" "$SAMPLE_DIR" "$START_MONTH" "$CURRENT_MONTH"
+      run_download "$topic" "$SAMPLE_DIR" "$START_MONTH" "$CURRENT_MONTH" "$codes_file"
     done
+
+    if [[ -n "$SAMPLE_TOLERANCE" ]]; then
+      # record the samples of the countries that used all of them
+      if ! check_convergence "$OUTPUT_DIR" "$MAX_SAMPLES" "$OUTPUT_DIR/pending_countries.csv"; then
+        echo "[ERROR] Convergence check failed after $MAX_SAMPLES samples, samples of $topic not recorded"
+        CONVERGENCE_FAILED=1
+      fi
+    fi
   done
+
+  if [[ -n "$CONVERGENCE_FAILED" ]]; then
+    exit 1
+  fi
 }
 
 main "$@"
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import their modules as lib.* from src, so the tests do too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from lib.detection import CROSTON_SBA_FACTOR, CrostonSBA, SlidingWindow
+
+
+def assert_matches_statsforecast(window):
+    np.testing.assert_allclose(window.croston_forecast(), CrostonSBA(window.to_array()).forecast(), rtol=1e-12)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_croston_forecast_follows_statsforecast(seed):
+    """Random insert/evict/replace/clear sequences keep the incremental levels equal to a refit."""
+    rng = np.random.default_rng(seed)
+    capacity = int(rng.integers(1, 20))
+    window = SlidingWindow(capacity)
+    timestamp = 0
+
+    for _ in range(200):
+        action = rng.random()
+        if action < 0.01:
+            window.clear()
+            timestamp = 0
+            continue
+        if action < 0.06 and len(window) > 0:
+            window.replace(rng.uniform(1, 100, len(window)))
+        elif action < 0.08 and len(window) > 0:
+            window.scale(rng.uniform(0.1, 10))
+        else:
+            # inserts past capacity evict the oldest observation
+            timestamp += int(rng.integers(1, 8))
+            window.insert(rng.uniform(1, 100), timestamp)
+        assert_matches_statsforecast(window)
+
+
+def test_croston_forecast_zero_demand():
+    window = SlidingWindow(5)
+    # nothing observed: no forecast (the detectors forecast 0), statsforecast has no series to fit
+    assert np.isnan(window.croston_forecast())
+    assert window.to_array().size == 0
+
+    for timestamp in range(1, 4):
+        window.insert(2.0, timestamp)
+    window.replace(np.zeros(len(window)))
+    assert window.croston_forecast() == 0
+    assert_matches_statsforecast(window)
+
+
+def test_croston_forecast_single_demand():
+    window = SlidingWindow(5)
+    window.insert(3.0, 4)
+    # a single observation is forecast as itself over its interarrival (the capacity for the first)
+    assert window.croston_forecast() == pytest.approx(3.0 / 5 * CROSTON_SBA_FACTOR)
+    assert_matches_statsforecast(window)
+
+    # a capacity-1 window holds a single demand after every eviction
+    window = SlidingWindow(1)
+    for timestamp, value in [(1, 4.0), (3, 7.0), (9, 2.0)]:
+        window.insert(value, timestamp)
+        assert_matches_statsforecast(window)
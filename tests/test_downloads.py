@@ -0,0 +1,85 @@
+import logging
+import threading
+
+import pytest
+
+from lib import trends_async
+from lib.download_journal import DONE, FAILED, PENDING, DownloadJournal
+from lib.google_trends_utils import WindowRequest, get_multi_timeline_queries
+from lib.request_plan import plan_requests
+
+LOGGER = logging.getLogger("tests")
+
+
+class Graph:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self, http=None):
+        return self.response
+
+
+class Service:
+    """getGraph answering every request with the points of one response."""
+    def __init__(self, response):
+        self.response = response
+        self.requests = 0
+
+    def getGraph(self, **parameters):
+        self.requests += 1
+        return Graph(self.response)
+
+
+def graph(*values):
+    return {"lines": [{"points": [{"date": f"2024-01-{day:02d}", "value": value} for day, value in enumerate(values, start=1)]}]}
+
+
+def window_requests(dest, n=3):
+    return [WindowRequest(str(dest), f"2024-{month:02d}_multiTimeline.csv", f"2024-{month:02d}", f"2024-{month + 7:02d}", "AA")
+            for month in range(1, n + 1)]
+
+
+def test_async_fetcher_stores_off_the_event_loop(tmp_path, monkeypatch):
+    stored_on = []
+    write_timeline = trends_async.write_timeline
+
+    def record_thread(*args, **kwargs):
+        stored_on.append(threading.current_thread())
+        write_timeline(*args, **kwargs)
+
+    monkeypatch.setattr(trends_async, "write_timeline", record_thread)
+    requests = window_requests(tmp_path)
+    stats = trends_async.download_windows(Service(graph(1, 2, 3)), LOGGER, plan_requests(requests).queries, rate=1000, burst=10)
+
+    assert stats["downloaded"] == len(requests)
+    assert len(stored_on) == len(requests) and threading.main_thread() not in stored_on
+    # one writer thread, so windows of a directory are never written at once
+    assert len(set(stored_on)) == 1
+    assert all((tmp_path / request.fname).is_file() for request in requests)
+
+
+def download(fetcher, service, queries, journal):
+    if fetcher == "async":
+        trends_async.download_windows(service, LOGGER, queries, journal=journal, rate=1000, burst=10)
+    else:
+        get_multi_timeline_queries(service, LOGGER, queries, journal=journal)
+
+
+@pytest.mark.parametrize("fetcher", ["process", "async"])
+def test_empty_response_is_requested_again_on_resume(tmp_path, fetcher):
+    requests = window_requests(tmp_path)
+    requests[-1] = requests[-1]._replace(drop_last=True)
+    journal = DownloadJournal(str(tmp_path))
+    journal.record(requests)
+
+    download(fetcher, Service({}), plan_requests(requests).queries, journal)
+    assert journal.counts() == {PENDING: 0, DONE: 0, FAILED: len(requests)}
+    assert not any((tmp_path / request.fname).exists() for request in requests)
+
+    # resuming plans every window again, and downloads them once the API answers
+    plan = plan_requests(requests, completed=journal.completed(requests))
+    assert plan.cost == len(requests)
+    download(fetcher, Service(graph(1, 2, 3)), plan.queries, journal)
+    assert journal.counts() == {PENDING: 0, DONE: len(requests), FAILED: 0}
+    assert plan_requests(requests, completed=journal.completed(requests)).queries == []
+    journal.close()
@@ -0,0 +1,83 @@
+import numpy as np
+import polars as pl
+import pytest
+import sklearn.neighbors
+
+from lib.detection import IsolationForest, LocalOutlierFactor
+
+
+def filled(detector, rng, size=60, values=None):
+    values = rng.uniform(10, 60, size) if values is None else values
+    for timestamp, value in enumerate(values, start=1):
+        detector._window.insert(value, timestamp)
+    return detector
+
+
+def refit_score(capacity, window, value):
+    """LocalOutlierFactor.score as first written: refit sklearn on the window plus the candidate."""
+    lof = sklearn.neighbors.LocalOutlierFactor(n_neighbors=capacity - 1, p=1)
+    lof.fit_predict(pl.DataFrame(np.append(window, value)))
+    return np.abs(lof.negative_outlier_factor_)[-1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("capacity, size", [(60, 60), (60, 10), (5, 5)])
+def test_local_outlier_factor_scores_refit_with_candidate(seed, capacity, size):
+    rng = np.random.default_rng(seed)
+    detector = filled(LocalOutlierFactor(capacity), rng, size)
+    window = detector._window.window
+
+    for value in np.append(np.linspace(window.mean(), 3 * window.max(), 25)[1:], rng.choice(window[window > window.mean()])):
+        assert detector.score(value) == pytest.approx(refit_score(capacity, window, value), rel=1e-12)
+    # at or below the mean nothing is an outlier
+    assert detector.score(window.mean() - 1) == 1
+
+
+def test_local_outlier_factor_with_duplicates():
+    rng = np.random.default_rng(0)
+    values = np.repeat(rng.uniform(10, 60, 20), 3)
+    detector = filled(LocalOutlierFactor(60), rng, values=rng.permutation(values))
+    window = detector._window.window
+
+    for value in np.append(np.linspace(window.mean(), 2 * window.max(), 10)[1:], window.max()):
+        assert detector.score(value) == pytest.approx(refit_score(60, window, value), rel=1e-12)
+
+
+def test_local_outlier_factor_fits_once_per_window_state():
+    rng = np.random.default_rng(0)
+    detector = filled(LocalOutlierFactor(60), rng)
+    fits = []
+    fit = detector._fit
+    detector._fit = lambda: fits.append(detector._fitted_version != detector._window._version) or fit()
+
+    detector.threshold(3 * detector._window.window.max())
+    assert sum(fits) == 1
+    detector._window.insert(30.0, 61)
+    detector.score(100.0)
+    assert sum(fits) == 2
+
+
+def test_isolation_forest_fits_once_per_window_state():
+    rng = np.random.default_rng(0)
+    detector = filled(IsolationForest(60), rng)
+    fits = []
+    fit = detector._iforest.fit
+    detector._iforest.fit = lambda *args, **kwargs: fits.append(1) or fit(*args, **kwargs)
+
+    detector.threshold(3 * detector._window.window.max())
+    assert len(fits) == 1
+    detector._window.insert(30.0, 61)
+    detector.score(100.0)
+    assert len(fits) == 2
+
+
+@pytest.mark.parametrize("detector_class", [IsolationForest, LocalOutlierFactor])
+def test_load_state_drops_fit_of_previous_window(detector_class):
+    rng = np.random.default_rng(0)
+    detector, other = filled(detector_class(60), rng), filled(detector_class(60), rng)
+    # both windows saw 60 inserts, so they are at the same version
+    assert detector._window._version == other._window._version
+    detector.score(100.0)
+
+    detector.load_state(other.state())
+    assert detector.score(100.0) == other.score(100.0)
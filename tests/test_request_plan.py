@@ -0,0 +1,42 @@
+import pandas as pd
+
+from lib import storage
+from lib.download_journal import DownloadJournal
+from lib.google_trends_utils import WindowRequest
+from lib.request_plan import plan_requests
+
+
+def run_requests(dest):
+    """Two windows of a run, the second of them final, both stored already."""
+    requests = [WindowRequest(str(dest), "2024-01_multiTimeline.csv", "2024-01", "2024-08", "AA"),
+                WindowRequest(str(dest), "2024-02_multiTimeline.csv", "2024-02", "2024-09", "AA", drop_last=True)]
+    for request in requests:
+        storage.write_window(request.dest, request.fname, pd.DataFrame({"date": ["2024-01-01", "2024-01-02"], "value": [1, 2]}))
+    return requests
+
+
+def planned(plan):
+    return [request.fname for query in plan.queries for request in query.requests]
+
+
+def test_final_window_on_disk_is_downloaded_again(tmp_path):
+    requests = run_requests(tmp_path)
+
+    plan = plan_requests(requests)
+    assert planned(plan) == ["2024-02_multiTimeline.csv"]
+    assert plan.on_disk == 1
+    assert len(plan_requests(requests, redownload=True).queries) == 2
+
+
+def test_final_window_journaled_done_today_is_not(tmp_path):
+    requests = run_requests(tmp_path)
+    journal = DownloadJournal(str(tmp_path))
+    journal.record(requests)
+    journal.mark_done(requests)
+
+    assert plan_requests(requests, completed=journal.completed(requests)).queries == []
+
+    # downloaded on an earlier day, its month has filled in since
+    journal.connection.execute("UPDATE windows SET updated = '2000-01-01T00:00:00'")
+    assert planned(plan_requests(requests, completed=journal.completed(requests))) == ["2024-02_multiTimeline.csv"]
+    journal.close()
@@ -0,0 +1,41 @@
+import os
+
+import pandas as pd
+
+from lib import storage
+from lib.download_journal import DownloadJournal
+from lib.google_trends_utils import WindowRequest
+from sample_convergence import country_sample_dirs
+
+FILES = ["2024-01_multiTimeline.csv", "2024-02_multiTimeline.csv",
+         "2024-01_coarseMultiTimeline.csv", "2024-02_coarseMultiTimeline.csv"]
+
+
+def sample(output_dir, i, files=FILES, journal=None):
+    """sample<i>/AA with the given windows stored and, with journal "done" or "failed", journaled so."""
+    sample_dir = os.path.join(output_dir, f"sample{i}")
+    dest = os.path.join(sample_dir, "AA")
+    os.makedirs(dest)
+    for fname in files:
+        storage.write_window(dest, fname, pd.DataFrame({"date": ["2024-01-01"], "value": [1]}))
+    if journal is not None:
+        requests = [WindowRequest(dest, fname, "2024-01", "2024-08", "AA") for fname in FILES]
+        download_journal = DownloadJournal(sample_dir)
+        download_journal.record(requests)
+        download_journal.mark_done(requests[:-1] if journal == "failed" else requests)
+        if journal == "failed":
+            download_journal.mark_failed(requests[-1:])
+        download_journal.close()
+    return dest
+
+
+def test_only_complete_samples_count(tmp_path):
+    output_dir = str(tmp_path)
+    counted = [sample(output_dir, 0, journal="done"), sample(output_dir, 1, journal="done")]
+    # a window failed in the journal, though every file is there from an earlier run
+    sample(output_dir, 2, journal="failed")
+    # downloaded before journaling, complete and not
+    counted.append(sample(output_dir, 3))
+    sample(output_dir, 4, files=FILES[:1] + FILES[2:])
+
+    assert country_sample_dirs(output_dir, "AA", 6) == counted